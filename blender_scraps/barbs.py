@@ -2,6 +2,8 @@
 
 import numpy as np
 
+import meshbuf
+import meshbundle
 import xform
 
 # Mnemonics:
@@ -38,28 +40,99 @@ class Barbs(object):
             translate(0.5, 0.0, 0.5)
             for i in range(4)
         ]
-        # Face & vertex accumulators:
-        self.faces = []
-        # self.faces will be a list of tuples (each one of length 4
-        # and containing indices into self.verts)
-        self.verts = []
-        # self.verts will be a list of np.array of shape (3,) but will
-        # be converted last-minute to tuples. (Why: we need to refer
-        # to prior vertices and arithmetic is much easier from an
-        # array, but Blender eventually needs tuples.)
+        # Face & vertex accumulator (see meshbuf.MeshBuffer):
+        self.mesh = meshbuf.MeshBuffer()
         self.creases_side = set()
         self.creases_joint = set()
 
-    def run(self, iters) -> (list, list):
+    def run(self, iters) -> tuple:
         # 'iters' is ignored for now
         # 
-        # Make seed vertices, use them for 'bottom' face, and recurse:
-        self.verts.extend(self.base)
-        self.faces.append((0, 1, 2, 3))
+        # Make seed vertices, use them for 'bottom' face, and grow.
+        # Returns (verts, loops, loop_start, loop_total) arrays - see
+        # meshbuf.MeshBuffer.
+        self.mesh.add_verts(self.base)
+        self.mesh.add_faces([(0, 1, 2, 3)])
+        self.grow(xform.Transform(), [0,1,2,3])
+        return self.mesh.arrays()
+
+    def run_recursive(self, iters) -> tuple:
+        # Same as run(), but with main() and barb() recursing one branch
+        # at a time.  (Vertices & faces come out in a different order.)
+        self.mesh.add_verts(self.base)
+        self.mesh.add_faces([(0, 1, 2, 3)])
         self.main(iters, xform.Transform(), [0,1,2,3])
-        verts = [tuple(v) for v in self.verts]
-        faces = [tuple(f) for f in self.faces]
-        return verts, faces
+        return self.mesh.arrays()
+
+    def grow(self, xf, bound):
+        # Breadth-first equivalent of self.main(..., xf, bound): rather
+        # than recursing, this handles every branch at the same depth at
+        # once, with its transforms in one xform.TransformArray and its
+        # 'bound' as one row of an array of shape (K,4).
+        mains = (xform.TransformArray(xf.mtx[np.newaxis]), np.array([bound]))
+        barbs = (xform.TransformArray.Identity(0), np.zeros((0, 4), dtype=int))
+        while len(mains[0]) or len(barbs[0]):
+            mains, new_barbs = self.main_level(*mains)
+            barbs = self.barb_level(*barbs)
+            barbs = (xform.TransformArray.concat([new_barbs[0], barbs[0]]),
+                     np.concatenate([new_barbs[1], barbs[1]]))
+
+    def limit_level(self, xfs, bounds):
+        # Batched limit_check: caps off every branch that is at its
+        # limit, and returns (xfs, bounds) of just the rest.
+        done = xfs.get_scale()[:, 0] < self.scale_min
+        # Note opposite winding order
+        self.mesh.add_faces(bounds[done][:, [3,2,1,0]])
+        return xfs[~done], bounds[~done]
+
+    def add_level(self, xfs):
+        # Append self.base transformed by each of 'xfs'; returns index of
+        # first vertex for each.
+        g = xfs.apply_to(self.base)
+        a0 = self.mesh.add_verts(g) + len(self.base) * np.arange(len(xfs))
+        return a0
+
+    def main_level(self, xfs, bounds):
+        # Batched main(); returns (xfs, bounds) for the next level of
+        # main() and for the first level of barb().
+        xfs, bounds = self.limit_level(xfs, bounds)
+        xfs2 = xfs.compose(self.base_incr)
+        a0 = self.add_level(xfs2)
+        i = np.arange(4)
+        j = (i + 1) % 4
+        a = a0[:, np.newaxis] + i
+        # Barb i starts from side i, going between b[i], b[j] and the
+        # same two corners of the next base:
+        barb_xfs = [xfs.compose(side) for side in self.sides]
+        barb_xfs = xform.TransformArray(
+            np.stack([x.mtx for x in barb_xfs], axis=1).reshape(-1, 4, 4))
+        barb_bounds = np.stack([bounds[:, i], bounds[:, j], a[:, j], a[:, i]],
+                               axis=-1).reshape(-1, 4)
+        self.creases_joint.update(zip(a.ravel().tolist(), a[:, j].ravel().tolist()))
+        self.creases_side.update(zip(bounds.ravel().tolist(), a.ravel().tolist()))
+        return (xfs2, a), (barb_xfs, barb_bounds)
+
+    def barb_level(self, xfs, bounds):
+        # Batched barb(); returns (xfs, bounds) for the next level.
+        xfs, bounds = self.limit_level(xfs, bounds)
+        xfs2 = xfs.compose(self.barb_incr)
+        offset = self.add_level(xfs2)
+        # Connect parallel faces:
+        n = len(self.base)
+        i = np.arange(n)
+        j = (i + 1) % n
+        a = offset[:, np.newaxis] + i
+        faces = np.stack([a, a[:, j], bounds[:, j], bounds], axis=-1)
+        self.mesh.add_faces(faces.reshape(-1, 4))
+        return xfs2, a
+
+    def save_bundle(self, fname):
+        # Write the mesh from run(), and which edges are in
+        # creases_joint & creases_side (as edge:joint & edge:side), as a
+        # mesh bundle (see meshbundle and meshload.load_bundle).
+        edges, attrs = meshbundle.edge_sets(joint=self.creases_joint,
+                                            side=self.creases_side)
+        self.mesh.save_bundle(fname, edges=edges, **attrs)
 
     def limit_check(self, xform: xform.Transform, iters) -> bool:
         # Assume all scales are the same (for now)
@@ -71,13 +144,12 @@ class Barbs(object):
         if self.limit_check(xform, iters):
             # Note opposite winding order
             verts = [bound[i] for i in [3,2,1,0]]
-            self.faces.append(verts)
+            self.mesh.add_faces([verts])
             return
 
         xform2 = xform.compose(self.base_incr)
         g = xform2.apply_to(self.base)
-        a0 = len(self.verts)
-        self.verts.extend(g)
+        a0 = self.mesh.add_verts(g)
 
         # TODO: Turn this to a cleaner loop?
         self.main(iters - 1, xform2, [a0, a0 + 1, a0 + 2, a0 + 3])
@@ -98,13 +170,12 @@ class Barbs(object):
         if self.limit_check(xform, iters):
             # Note opposite winding order
             verts = [bound[i] for i in [3,2,1,0]]
-            self.faces.append(verts)
+            self.mesh.add_faces([verts])
             return
 
         xform2 = xform.compose(self.barb_incr)
         g = xform2.apply_to(self.base)
-        offset = len(self.verts)
-        self.verts.extend(g)
+        offset = self.mesh.add_verts(g)
 
         # Connect parallel faces:
         n = len(self.base)
@@ -113,6 +184,6 @@ class Barbs(object):
             b1 = bound[j]
             a0 = offset + i
             a1 = offset + j
-            self.faces.append([a0, a1, b1, b0])
+            self.mesh.add_faces([(a0, a1, b1, b0)])
 
         self.barb(iters-1, xform2, [offset, offset + 1, offset + 2, offset + 3])
@@ -2,6 +2,7 @@
 import sys
 import importlib
 import bpy
+import numpy as np
 
 ext_path = "/home/hodapp/source/automata_scratch/blender_scraps"
 if ext_path not in sys.path:
@@ -9,15 +10,14 @@ if ext_path not in sys.path:
 
 import menger_cube_ish
 menger_cube_ish = importlib.reload(menger_cube_ish)
+import meshload
+meshload = importlib.reload(meshload)
 
-v,f = menger_cube_ish.cube_iterate(4)
+# (cull=True: no faces where one cube meets the next)
+v,f = menger_cube_ish.cube_iterate(4, cull=True)
 
-mesh = bpy.data.meshes.new('mesh_thing')
-mesh.from_pydata(v, [], f)
-mesh.update(calc_edges=True)
-for edge in mesh.edges:
-    v = list(edge.vertices)
-    edge.crease = 0.9
+# (Rather than mesh.from_pydata and setting each edge's crease:)
+mesh = meshload.new_mesh('mesh_thing', np.asarray(v), *meshload.faces_to_loops(f))
+meshload.set_crease_values(mesh, np.full(len(mesh.edges), 0.9))
 
-obj = bpy.data.objects.new('obj_thing', mesh)
-bpy.context.scene.collection.objects.link(obj)
+obj = meshload.add_object('obj_thing', mesh)
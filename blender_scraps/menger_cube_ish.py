@@ -1,4 +1,6 @@
 # 2021-06-28, Chris Hodapp
+import functools
+
 import numpy as np
 
 # Run this in Blender.  See something like loader.py.
@@ -7,23 +9,47 @@ import numpy as np
 # something like the first stage of a Menger sponge.  There is a lot
 # of extra work being done here.
 
+# cube_iterate doesn't call cube_thing for every cube, but only to get
+# tables of how vertices and faces are made (see _cube_tables), which
+# it then applies to all the cubes at once with NumPy.
+
+# With cull=True, cube_iterate leaves out the faces where one cube meets
+# the next (face 3 of one cube is face 0 of the next), which are inside
+# the solid anyway; see 'skip' in cube_thing.
+
 # Known bugs:
 # - Doesn't set the crease properly always?
-# - I need to properly denote which faces *don't* need built
-# (but I still need to run most code paths on all faces because
-# of the structures they build up)
 # - I handle only the main 4 vertices and no others
 
 # Adjust 'f' to set the size of the central hole. (f=1/3 is 'normal')
 #f = 1/4
-def cube_thing(vert_accum, face_accum, base_idxs, vert_between=None, f=1/4):
+#
+# If 'log' is True, this prints all sorts of things as it goes.  If
+# 'parents' is a list, then for every vertex added, (a, b) is appended to
+# it to say that vertex is 'f' of the way from vertex a to b - or (a, -1)
+# if it's vertex a moved along to the next cube.
+#
+# 'skip' gives indices (into 'faces' below) of faces that are not built:
+# they still get their edge splits & face-split vertices, because the
+# rest of the cube is made from those, but no faces.  If a skipped face
+# was also a face of the previous cube (face 0, when base_idxs came from
+# the last call), its face-split vertices are taken from that cube
+# rather than made again.
+def cube_thing(vert_accum, face_accum, base_idxs, vert_between=None, f=1/4,
+               log=False, parents=None, skip=()):
     xform = lambda v: v + np.array([2.0, 0.0, 0.0])
+    def add_vert(coord, a, b=-1):
+        if parents is not None:
+            parents.append((a, b))
+        vert_accum.append(coord)
+        return len(vert_accum) - 1
     v0,v1,v2,v3 = base_idxs
     v4 = len(vert_accum)
     v5 = v4+1
     v6 = v5+1
     v7 = v6+1
-    vert_accum.extend([xform(vert_accum[i]) for i in base_idxs])
+    for i in base_idxs:
+        add_vert(xform(vert_accum[i]), i)
     faces = [
         (v0,v1,v2,v3),
         (v4,v5,v1,v0),
@@ -53,10 +79,12 @@ def cube_thing(vert_accum, face_accum, base_idxs, vert_between=None, f=1/4):
     # nearest to the vertices in faces[i]
     face_inner_vertex = [None for _ in faces]
     for f_idx, vert_idxs in enumerate(faces):
+        build = f_idx not in skip
         n = len(vert_idxs)
         face_inner_vertex[f_idx] = [None]*len(vert_idxs)
         # Split each edge:
-        print(f"{vert_idxs}:")
+        if log:
+            print(f"{vert_idxs}:")
         for i, v in enumerate(vert_idxs):
             # v = 'current' vertex index.
             # vp = 'previous' vertex, vn = 'next' vertex:
@@ -65,17 +93,16 @@ def cube_thing(vert_accum, face_accum, base_idxs, vert_between=None, f=1/4):
             coord_v = vert_accum[v]
             coord_vp = vert_accum[vp]
             coord_vn = vert_accum[vn]
-            print(f"{v}:{coord_v} {vp}:{coord_vp} {vn}:{coord_vn}")
+            if log:
+                print(f"{v}:{coord_v} {vp}:{coord_vp} {vn}:{coord_vn}")
             # Go f of way from v to vn:
             if (v,vn) not in vert_between:
                 coord_vnf = (1-f)*coord_v + f*coord_vn
-                vert_between[(v, vn)] = len(vert_accum)
-                vert_accum.append(coord_vnf)
+                vert_between[(v, vn)] = add_vert(coord_vnf, v, vn)
             # and from v to vp:
             if (v,vp) not in vert_between:
                 coord_vpf = (1-f)*coord_v + f*coord_vp
-                vert_between[(v, vp)] = len(vert_accum)
-                vert_accum.append(coord_vpf)
+                vert_between[(v, vp)] = add_vert(coord_vpf, v, vp)
         # Now, go 'across' those new edge splits too.
         # In particular, if starting at vertex i, and vertex j is next,
         # then join between:
@@ -88,16 +115,23 @@ def cube_thing(vert_accum, face_accum, base_idxs, vert_between=None, f=1/4):
             vj_next = vert_idxs[(j + 1) % n]
             vi_split = vert_between[(vi, vi_prev)]
             vj_split = vert_between[(vj, vj_next)]
-            coord = (1-f)*vert_accum[vi_split] + f*vert_accum[vj_split]
-            # vb = our new vertex between vi_split & vj_split:
-            vb = len(vert_accum)
+            # This is also between two others:
+            other = (vert_between[(vi,vj)], vert_between[(vi_prev,vj_next)])
+            # (and if the previous cube had this face, walking it the
+            # other way, then it made this vertex already under that key)
+            vb = vert_between.get(other) if not build else None
+            if vb is None:
+                coord = (1-f)*vert_accum[vi_split] + f*vert_accum[vj_split]
+                # vb = our new vertex between vi_split & vj_split:
+                vb = add_vert(coord, vi_split, vj_split)
             vert_between[(vi_split, vj_split)] = vb
             face_inner_vertex[f_idx][i] = vb
-            vert_accum.append(coord)
-            # note that this is also between two others:
-            vert_between[(vert_between[(vi,vj)], vert_between[(vi_prev,vj_next)])] = vb
+            vert_between[other] = vb
             # As we do this, make corner faces, because we know the vertices:
-            face_accum.append((vi, vert_between[(vi, vj)], vb, vi_split))
+            if build:
+                face_accum.append((vi, vert_between[(vi, vj)], vb, vi_split))
+        if not build:
+            continue
         # and make faces between those:
         for i, vi in enumerate(vert_idxs):
             vi_next = vert_idxs[(i + 1) % n]
@@ -127,9 +161,10 @@ def cube_thing(vert_accum, face_accum, base_idxs, vert_between=None, f=1/4):
     # 'opposite' vertices at the same index.
     face_remap_opp = [None for _ in faces]
 
+    corners = list(vert_to_faces.keys())
     # TODO: Feels a little wrong to hard-code?
     for vi in range(8):
-        v = list(vert_to_faces.keys())[vi]
+        v = corners[vi]
         # f_inc = all faces incident on corner v
         f_inc = vert_to_faces[v]
         for i,f0_idx in enumerate(f_inc):
@@ -173,7 +208,7 @@ def cube_thing(vert_accum, face_accum, base_idxs, vert_between=None, f=1/4):
     # I don't even know... mark out the redundant ways of reaching the
     # same 8 inner vertices.
     for vi in range(8):
-        v = list(vert_to_faces.keys())[vi]
+        v = corners[vi]
         # f_inc = all faces incident on corner v
         f_inc = vert_to_faces[v]
         for k,f0_idx in enumerate(f_inc):
@@ -185,12 +220,14 @@ def cube_thing(vert_accum, face_accum, base_idxs, vert_between=None, f=1/4):
             f_opp = [faces[f_opp_idx][j] for j in remap]
             # That is, f0[i] and f_opp[i] are opposite vertices (they have one
             # edge between them and sit on opposite faces).
-            print(f"face {f0_idx}: {f0} opposite {f_opp}")
+            if log:
+                print(f"face {f0_idx}: {f0} opposite {f_opp}")
             # Now, translate this to their corresponding nearest face-split vertices
             # on their respective faces.
             f0_split = face_inner_vertex[f0_idx]
             f_opp_split = [face_inner_vertex[f_opp_idx][j] for j in remap]
-            print(f"face {f0_idx} inner: {f0_split} opposite {f_opp_split}")
+            if log:
+                print(f"face {f0_idx} inner: {f0_split} opposite {f_opp_split}")
             # Make 'inner' vertices nearest f0_split & f_opp_split:
             for i,(m,n) in enumerate(zip(f0_split, f_opp_split)):
                 equiv = [(m,n)]
@@ -200,7 +237,8 @@ def cube_thing(vert_accum, face_accum, base_idxs, vert_between=None, f=1/4):
                         # Ignore the same face.
                         continue
                     f1_opp_idx = face_idx_opp[f1_idx]
-                    print(f"f0_idx={f0_idx}, f0[i]={f0[i]}, f1_idx={f1_idx} opposite={f1_opp_idx}")
+                    if log:
+                        print(f"f0_idx={f0_idx}, f0[i]={f0[i]}, f1_idx={f1_idx} opposite={f1_opp_idx}")
                     # Find f0[i] in that neighbor face f1...
                     f1_v_idx = faces[f1_idx].index(f0[i])
                     # ...so we can find this neighbor face's face-split vertex
@@ -209,7 +247,8 @@ def cube_thing(vert_accum, face_accum, base_idxs, vert_between=None, f=1/4):
                     # and then find the vertex across from that:
                     remap2 = face_remap_opp[f1_idx][f1_v_idx]
                     v_opp_split = face_inner_vertex[f1_opp_idx][remap2]
-                    print(f"    nearest split vertex: {v_f1_split}, opp {v_opp_split}")
+                    if log:
+                        print(f"    nearest split vertex: {v_f1_split}, opp {v_opp_split}")
                     equiv.append((v_f1_split, v_opp_split))
                 found = None
                 for m2,n2 in equiv:
@@ -218,15 +257,15 @@ def cube_thing(vert_accum, face_accum, base_idxs, vert_between=None, f=1/4):
                         break
                 if found is None:
                     vert = (1-f)*vert_accum[m] + f*vert_accum[n]
-                    found = len(vert_accum)
-                    vert_accum.append(vert)
+                    found = add_vert(vert, m, n)
                 for m2,n2 in equiv:
                     vert_between[(m2,n2)] = found
-                print(f"equivalent between verts {m},{n}: {equiv}")
+                if log:
+                    print(f"equivalent between verts {m},{n}: {equiv}")
 
     # Pick a vertex:
     vi = 3
-    v = list(vert_to_faces.keys())[vi]
+    v = corners[vi]
     f_inc = vert_to_faces[v]
 
     for k,f0_idx in enumerate(f_inc):
@@ -266,13 +305,138 @@ base_verts = [
 ]
 base_verts = [np.array(t) for t in base_verts]
 
-def cube_iterate(count=4):
-    f = []
+# Cubes in cube_iterate after the first few are all made the same way,
+# just shifted along in vertex indices - except the last one, which
+# (with cull=True) also has its face 3 built:
+_cube_traced = 3
+
+def _cube_skip(i, count, cull):
+    # Faces that cube i of 'count' doesn't build (see cube_thing)
+    if not cull:
+        return ()
+    skip = []
+    if i > 0:
+        # Face 0 is the previous cube's face 3:
+        skip.append(0)
+    if i < count - 1:
+        # ...and face 3 is the next cube's face 0:
+        skip.append(3)
+    return skip
+
+def _cube_run(count, f=1/4, log=False, cull=False, parents=None):
+    # Call cube_thing for 'count' cubes.  Returns (v, fs, vstart, fstart)
+    # where v & fs are lists of vertices & faces, and vstart & fstart
+    # give the index of each cube's first vertex & face (with one more
+    # entry at the end for the totals).
+    fs = []
     btw = {}
     v = base_verts.copy()
     idxs = [i for i,_ in enumerate(base_verts)]
+    vstart = []
+    fstart = []
     for i in range(count):
-        print(i)
-        v,f,idxs,btw = cube_thing(v, f, idxs, btw)
+        if log:
+            print(i)
+        vstart.append(len(v))
+        fstart.append(len(fs))
+        v,fs,idxs,btw = cube_thing(v, fs, idxs, btw, f=f, log=log,
+                                   parents=parents,
+                                   skip=_cube_skip(i, count, cull))
+    vstart.append(len(v))
+    fstart.append(len(fs))
+    return v, fs, vstart, fstart
+
+@functools.lru_cache()
+def _cube_tables(count, cull):
+    # Run cube_thing for 'count' cubes (coordinates don't matter, only
+    # indices) to get:
+    # parents -- (a, b) for each vertex, as for cube_thing's 'parents'
+    #            (base vertices have (-1, -1))
+    # faces -- array of shape (M,4) of all faces
+    # vstart, fstart -- as from _cube_run
+    # depth -- for each vertex, the number of steps of lerping needed to
+    #          get it from the corners (0 for the corners themselves)
+    # hops -- for corners, how many cubes along from the base it is
+    # root -- for corners, the base vertex it was moved from
+    parents = [(-1, -1)] * len(base_verts)
+    _, fs, vstart, fstart = _cube_run(count, cull=cull, parents=parents)
+    parents = np.array(parents)
+    faces = np.array(fs).reshape(-1, 4)
+    depth = np.zeros(len(parents), dtype=int)
+    hops = np.zeros(len(parents), dtype=int)
+    root = np.arange(len(parents))
+    for i, (a, b) in enumerate(parents):
+        if b >= 0:
+            depth[i] = max(depth[a], depth[b]) + 1
+        elif a >= 0:
+            hops[i] = hops[a] + 1
+            root[i] = root[a]
+    return parents, faces, vstart, fstart, depth, hops, root
+
+def cube_iterate(count=4, f=1/4, cull=False):
+    # Returns (v, f): vertex coordinates, shape (N,3), and faces as
+    # vertex indices, shape (M,4) - exactly what calling cube_thing
+    # 'count' times (as in cube_iterate_slow) would give, but built with
+    # a handful of NumPy operations however big 'count' is.
+    #
+    # If 'cull' is True, faces between one cube and the next are left
+    # out (and vertices on them are shared rather than made twice).
+    k = _cube_traced
+    if count <= k + 1:
+        tables = _cube_tables(count, cull)
+        # (start, stop, cubes shifted along) for vertices & faces:
+        vseg = [(0, tables[2][count], 0)]
+        fseg = [(0, tables[3][count], 0)]
+        m = dv = 0
+    else:
+        # Cubes up to k are taken straight from the tables; after that,
+        # every cube is cube k again, shifted along by 'dv' vertices,
+        # and the last cube is the table's last cube shifted along.
+        tables = _cube_tables(k + 2, cull)
+        vstart, fstart = tables[2], tables[3]
+        m = count - (k + 2)
+        vseg = [(0, vstart[k+1], 0)] + \
+            [(vstart[k], vstart[k+1], j) for j in range(1, m + 1)] + \
+            [(vstart[k+1], vstart[k+2], m)]
+        fseg = [(0, fstart[k+1], 0)] + \
+            [(fstart[k], fstart[k+1], j) for j in range(1, m + 1)] + \
+            [(fstart[k+1], fstart[k+2], m)]
+        dv = vstart[k+1] - vstart[k]
+    parents, faces, vstart, fstart, depth, hops, root = tables
+    if m:
+        # Check that cube k really is cube k-1 shifted by 'dv' vertices,
+        # so that repeating it is right (not with assert, so that this
+        # still happens under python -O):
+        block = parents[vstart[k-1]:vstart[k]]
+        if not (dv == vstart[k] - vstart[k-1] and
+                (np.where(block >= 0, block + dv, -1) ==
+                 parents[vstart[k]:vstart[k+1]]).all() and
+                (faces[fstart[k-1]:fstart[k]] + dv ==
+                 faces[fstart[k]:fstart[k+1]]).all()):
+            raise RuntimeError(
+                "cube_iterate: traced cube {} is not cube {} shifted by {} "
+                "vertices (cull={}), so it can't be repeated".format(
+                    k, k-1, dv, cull))
+    p = np.concatenate([np.where(parents[a:b] >= 0, parents[a:b] + j*dv, -1)
+                        for a, b, j in vseg])
+    d = np.concatenate([depth[a:b] for a, b, _ in vseg])
+    h = np.concatenate([hops[a:b] + j for a, b, j in vseg])
+    r = np.concatenate([root[a:b] for a, b, _ in vseg])
+    fs = np.concatenate([faces[a:b] + j*dv for a, b, j in fseg])
+    # Corners are base vertices moved along by 2 for every cube:
+    v = np.zeros((p.shape[0], 3))
+    corner = p[:, 1] < 0
+    v[corner] = np.array(base_verts)[r[corner]]
+    v[corner, 0] += 2.0 * h[corner]
+    # Everything else is between two vertices made earlier:
+    for level in range(1, d.max(initial=0) + 1):
+        i = np.flatnonzero(d == level)
+        a, b = p[i, 0], p[i, 1]
+        v[i] = (1-f)*v[a] + f*v[b]
+    return v, fs
+
+def cube_iterate_slow(count=4, f=1/4, log=False, cull=False):
+    # The same as cube_iterate, but calling cube_thing for every cube.
+    v, fs, _, _ = _cube_run(count, f, log, cull)
     v = [tuple(i) for i in v]
-    return v,f
+    return v,fs
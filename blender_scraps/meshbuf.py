@@ -0,0 +1,79 @@
+import numpy as np
+
+import meshbundle
+
+def _grow(arr, count):
+    # Returns 'arr', or a copy at least twice as long, so that it has
+    # room for 'count' rows.
+    if count <= arr.shape[0]:
+        return arr
+    arr2 = np.zeros((max(count, 2*arr.shape[0]),) + arr.shape[1:],
+                    dtype=arr.dtype)
+    arr2[:arr.shape[0]] = arr
+    return arr2
+
+class MeshBuffer(object):
+    """Accumulates vertices & faces in contiguous, growable arrays laid out
+    the way Blender's Mesh stores them:
+
+    verts -- float32, shape (N,3): vertex coordinates
+    loops -- int32, shape (L,): vertex index of every corner of every
+    face, face after face
+    loop_start -- int32, shape (F,): index in 'loops' of each face's first
+    corner
+    loop_total -- int32, shape (F,): number of corners in each face
+
+    so that arrays() can go straight to foreach_set (after ravel() for
+    'verts') with no Python object per element.
+    """
+    def __init__(self, nv=1024, nf=1024):
+        self._verts = np.zeros((nv, 3), dtype=np.float32)
+        self._loops = np.zeros(4*nf, dtype=np.int32)
+        self._loop_start = np.zeros(nf, dtype=np.int32)
+        self._loop_total = np.zeros(nf, dtype=np.int32)
+        self.nv = 0
+        self.nl = 0
+        self.nf = 0
+
+    def add_verts(self, vs) -> int:
+        # vs has shape (N,3).  Returns the index of the first one.
+        vs = np.asarray(vs).reshape(-1, 3)
+        n0 = self.nv
+        self.nv += vs.shape[0]
+        self._verts = _grow(self._verts, self.nv)
+        self._verts[n0:self.nv] = vs
+        return n0
+
+    def add_faces(self, fs):
+        # fs has shape (M,K): M faces of K vertex indices each.
+        fs = np.asarray(fs)
+        m, k = fs.shape
+        l0 = self.nl
+        f0 = self.nf
+        self.nl += m*k
+        self.nf += m
+        self._loops = _grow(self._loops, self.nl)
+        self._loop_start = _grow(self._loop_start, self.nf)
+        self._loop_total = _grow(self._loop_total, self.nf)
+        self._loops[l0:self.nl] = fs.ravel()
+        self._loop_start[f0:self.nf] = l0 + k*np.arange(m)
+        self._loop_total[f0:self.nf] = k
+
+    def arrays(self):
+        # Returns (verts, loops, loop_start, loop_total) as described
+        # above.  These are views, not copies, of our buffers.
+        return (self._verts[:self.nv], self._loops[:self.nl],
+                self._loop_start[:self.nf], self._loop_total[:self.nf])
+
+    def to_pydata(self) -> (list, list):
+        # Lists of tuples, as for mesh.from_pydata (slow for big meshes).
+        verts, loops, starts, totals = self.arrays()
+        faces = [tuple(loops[s:s+t].tolist()) for s, t in zip(starts, totals)]
+        return [tuple(v) for v in verts.tolist()], faces
+
+    def save_bundle(self, fname, **kw):
+        # Write as a mesh bundle (see meshbundle); 'kw' is passed to
+        # meshbundle.mesh_sections, e.g. edges=... or vertex_NAME=...
+        verts, loops, starts, totals = self.arrays()
+        meshbundle.write_mesh(fname, verts, loops=loops, loop_start=starts,
+                              loop_total=totals, **kw)
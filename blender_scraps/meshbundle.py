@@ -0,0 +1,170 @@
+# A single-file container for a mesh and any arrays that go with it
+# (crease weights, curvatures, ...), meant to be memory-mapped.
+#
+# It is used to get meshes from python_extrude_meshgen, from
+# barbs/tree_thing, and from libfive_subdiv into Blender (see
+# meshload.load_bundle) without the index mix-ups of going through STL,
+# and without separate .npy files that each must be loaded in full.
+#
+# Layout (all little-endian):
+#
+#   magic      8 bytes, b"MESHBNDL"
+#   version    uint32 (currently 1)
+#   count      uint32, number of sections
+#   table      'count' entries of 96 bytes each (see _entry):
+#              name (32 bytes, UTF-8, NUL-padded; longer is an
+#              error), dtype (8 bytes, NumPy dtype string e.g.
+#              b"<f4"), ndim (uint32), 4 pad bytes, shape (4 x
+#              uint64), offset (uint64), nbytes (uint64)
+#   data       each section's array, C order, starting at its 'offset'
+#              (a multiple of ALIGN from the start of the file)
+#
+# Section names in use:
+#
+#   verts               (N,3) vertex positions
+#   faces               (M,K) vertex indices, if all faces have K sides
+#   loops, loop_start, loop_total
+#                       faces of any size, as in meshbuf.MeshBuffer
+#   edges               (E,2) vertex indices of edges; need not be all
+#                       of the mesh's edges, only those that have
+#                       edge attributes
+#   vertex:NAME         per-vertex attribute, first dimension N
+#   edge:NAME           per-edge attribute, first dimension E
+#   face:NAME           per-face attribute, first dimension M
+#   corner:NAME         per face-corner attribute, e.g. shape (M,3) for
+#                       something per triangle edge (edge j of a face
+#                       going from its corner j to corner j+1)
+
+import struct
+
+import numpy as np
+
+MAGIC = b"MESHBNDL"
+VERSION = 1
+# Alignment of every section, in bytes:
+ALIGN = 64
+
+_head = struct.Struct("<8sII")
+_entry = struct.Struct("<32s8sI4x4QQQ")
+# Longest section name, in bytes of UTF-8 (struct would silently cut
+# longer ones short):
+NAME_MAX = 32
+
+def _align(n):
+    return -(-n // ALIGN) * ALIGN
+
+def write(fname, sections):
+    """Write a bundle to 'fname'.  'sections' is a dict (or list of pairs)
+    of section name to array (or anything np.asarray accepts)."""
+    if isinstance(sections, dict):
+        sections = sections.items()
+    arrays = []
+    for name, arr in sections:
+        if len(name.encode("utf-8")) > NAME_MAX:
+            raise ValueError("Section name {} is longer than {} bytes".format(
+                name, NAME_MAX))
+        arr = np.ascontiguousarray(arr)
+        if arr.ndim > 4:
+            raise ValueError("Section {} has {} dimensions; at most 4 allowed".format(
+                name, arr.ndim))
+        if arr.dtype.hasobject:
+            raise ValueError("Section {} has object dtype".format(name))
+        arrays.append((name, arr.astype(arr.dtype.newbyteorder("<"), copy=False)))
+    offset = _align(_head.size + _entry.size*len(arrays))
+    table = []
+    for name, arr in arrays:
+        shape = list(arr.shape) + [0]*(4 - arr.ndim)
+        table.append(_entry.pack(name.encode("utf-8"), arr.dtype.str.encode("ascii"),
+                                 arr.ndim, *shape, offset, arr.nbytes))
+        offset = _align(offset + arr.nbytes)
+    with open(fname, "wb") as fd:
+        fd.write(_head.pack(MAGIC, VERSION, len(arrays)))
+        for t in table:
+            fd.write(t)
+        for name, arr in arrays:
+            fd.write(b"\0" * (_align(fd.tell()) - fd.tell()))
+            fd.write(arr.reshape(-1).view(np.uint8))
+
+def read(fname, mmap=True):
+    """Read a bundle from 'fname', returning a dict of section name to
+    array.  With 'mmap' (the default), arrays are read-only memory maps
+    of the file, so nothing is read until it is used."""
+    with open(fname, "rb") as fd:
+        magic, version, count = _head.unpack(fd.read(_head.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not a mesh bundle".format(fname))
+        if version != VERSION:
+            raise ValueError("{} is mesh bundle version {}; only {} supported".format(
+                fname, version, VERSION))
+        table = [_entry.unpack(fd.read(_entry.size)) for _ in range(count)]
+    sections = {}
+    for name, dtype, ndim, *rest in table:
+        shape = tuple(rest[:ndim])
+        offset = rest[4]
+        nbytes = rest[5]
+        name = name.rstrip(b"\0").decode("utf-8")
+        dtype = np.dtype(dtype.rstrip(b"\0").decode("ascii"))
+        if nbytes == 0:
+            # (mmap can't map zero bytes)
+            arr = np.zeros(shape, dtype=dtype)
+        elif mmap:
+            arr = np.memmap(fname, dtype=dtype, mode="r", offset=offset, shape=shape)
+        else:
+            arr = np.fromfile(fname, dtype=dtype, count=nbytes // dtype.itemsize,
+                              offset=offset).reshape(shape)
+        sections[name] = arr
+    return sections
+
+def mesh_sections(verts, faces=None, loops=None, loop_start=None,
+                  loop_total=None, edges=None, **attrs):
+    """Return sections (for write) for a mesh, from either 'faces' (shape
+    (M,K)) or 'loops'/'loop_start'/'loop_total', plus optional 'edges'
+    and attributes passed as e.g. vertex_NAME=..., edge_NAME=...,
+    face_NAME=..., corner_NAME=... (which become vertex:NAME etc.)."""
+    sections = [("verts", verts)]
+    if faces is not None:
+        sections.append(("faces", faces))
+    else:
+        sections += [("loops", loops), ("loop_start", loop_start),
+                     ("loop_total", loop_total)]
+    if edges is not None:
+        sections.append(("edges", edges))
+    for key, arr in attrs.items():
+        domain, _, name = key.partition("_")
+        if domain not in ("vertex", "edge", "face", "corner") or not name:
+            raise ValueError("Bad attribute {}; need vertex_, edge_, face_ or corner_ prefix".format(key))
+        sections.append((domain + ":" + name, arr))
+    return sections
+
+def write_mesh(fname, verts, faces=None, **kw):
+    """Write a mesh bundle; arguments are as for mesh_sections."""
+    write(fname, mesh_sections(verts, faces, **kw))
+
+def bundle_loops(bundle):
+    """Return (loops, loop_start, loop_total) for the faces in a bundle
+    (from read), whichever way they were stored."""
+    if "faces" in bundle:
+        faces = bundle["faces"]
+        m, k = faces.shape
+        return (faces.reshape(-1), k*np.arange(m, dtype=np.int32),
+                np.full(m, k, dtype=np.int32))
+    return bundle["loops"], bundle["loop_start"], bundle["loop_total"]
+
+def edge_sets(**sets):
+    """Turn sets of (vi, vj) tuples (undirected edges) into one edge array
+    for a bundle, plus a flag for each set saying which edges are in it.
+    Returns (edges, attrs) where 'edges' has shape (E,2) and 'attrs' maps
+    edge_NAME to a uint8 array of shape (E,), for mesh_sections."""
+    pairs = [np.array(list(s), dtype=np.int64).reshape(-1, 2) for s in sets.values()]
+    pairs = [np.sort(p, axis=1) for p in pairs]
+    edges = np.unique(np.concatenate(pairs + [np.zeros((0, 2), dtype=np.int64)]), axis=0)
+    attrs = {}
+    for name, p in zip(sets, pairs):
+        flags = np.zeros(edges.shape[0], dtype=np.uint8)
+        if p.size:
+            # Rows of 'edges' are sorted, so each row of p can be found
+            # by its combined key:
+            keys = edges[:, 0] * (edges.max() + 1) + edges[:, 1]
+            flags[np.searchsorted(keys, p[:, 0] * (edges.max() + 1) + p[:, 1])] = 1
+        attrs["edge_" + name] = flags
+    return edges.astype(np.int32), attrs
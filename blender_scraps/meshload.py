@@ -0,0 +1,153 @@
+# Meant to be used with Blender's Python API: bulk loading of meshes
+# and creases from flat NumPy arrays.
+#
+# mesh.from_pydata, and setting creases edge by edge (in bmesh or
+# otherwise), go through one Python object per vertex/face/edge, which
+# takes minutes for big control cages.  Everything here goes through
+# foreach_set/foreach_get on whole arrays instead.
+#
+# Typical use (e.g. with barbs.Barbs):
+#
+#     b = barbs.Barbs()
+#     mesh = meshload.new_mesh('barbs', *b.run(0))
+#     meshload.set_creases(mesh, b.creases_joint, 0.7)
+#     obj = meshload.add_object('barbs', mesh)
+#
+# The functions that don't take a mesh need only NumPy.
+
+import numpy as np
+
+import meshbundle
+
+def faces_to_loops(faces):
+    """Convert faces to the loops/loop_start/loop_total layout (see
+    meshbuf.MeshBuffer).
+
+    'faces' may be an array of shape (M,K) or any sequence of sequences
+    of vertex indices (faces of differing sizes are fine).
+    """
+    if isinstance(faces, np.ndarray):
+        m, k = faces.shape
+        totals = np.full(m, k, dtype=np.int32)
+        loops = faces.astype(np.int32).ravel()
+    else:
+        totals = np.fromiter((len(f) for f in faces), dtype=np.int32,
+                             count=len(faces))
+        loops = np.fromiter((i for f in faces for i in f), dtype=np.int32,
+                            count=int(totals.sum()))
+    starts = np.zeros_like(totals)
+    np.cumsum(totals[:-1], out=starts[1:])
+    return loops, starts, totals
+
+def new_mesh(name, verts, loops, loop_start, loop_total):
+    """Create a Blender mesh from vertices (shape (N,3)) and faces in the
+    loops/loop_start/loop_total layout, e.g. from meshbuf.MeshBuffer or
+    faces_to_loops.  Edges are computed from the faces."""
+    import bpy
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(verts.shape[0])
+    mesh.vertices.foreach_set("co", np.asarray(verts, dtype=np.float32).ravel())
+    mesh.loops.add(loops.shape[0])
+    mesh.loops.foreach_set("vertex_index", np.asarray(loops, dtype=np.int32))
+    mesh.polygons.add(loop_start.shape[0])
+    mesh.polygons.foreach_set("loop_start", np.asarray(loop_start, dtype=np.int32))
+    if bpy.app.version < (4, 0, 0):
+        # (Since 4.0 this is read-only, and implied by loop_start)
+        mesh.polygons.foreach_set("loop_total", np.asarray(loop_total, dtype=np.int32))
+    mesh.update(calc_edges=True)
+    return mesh
+
+def mesh_edges(mesh):
+    """Return the vertex indices of every edge of 'mesh', shape (E,2)."""
+    edges = np.zeros(2*len(mesh.edges), dtype=np.int32)
+    mesh.edges.foreach_get("vertices", edges)
+    return edges.reshape(-1, 2)
+
+def edge_keys(pairs):
+    """Return an int64 key for each undirected edge in 'pairs' (shape
+    (E,2)), the same whichever way round the edge is given."""
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    lo = pairs.min(axis=1)
+    hi = pairs.max(axis=1)
+    return (lo << 32) | hi
+
+def edge_lookup(edges, pairs):
+    """For each edge in 'edges' (shape (E,2)), return the index of the
+    same undirected edge in 'pairs' (shape (M,2), or a set of (vi, vj)
+    tuples), or -1 where there is none."""
+    if isinstance(pairs, (set, frozenset)):
+        pairs = list(pairs)
+    want = edge_keys(pairs)
+    if want.size == 0:
+        return np.full(len(edges), -1)
+    order = np.argsort(want, kind="stable")
+    want = want[order]
+    keys = edge_keys(edges)
+    idx = np.searchsorted(want, keys)
+    idx[idx == want.size] = 0
+    return np.where(want[idx] == keys, order[idx], -1)
+
+def edge_mask(edges, pairs):
+    """For each edge in 'edges' (shape (E,2)), return whether it is in
+    'pairs' (as for edge_lookup), in either direction."""
+    return edge_lookup(edges, pairs) >= 0
+
+def set_crease_values(mesh, values):
+    """Set the crease of every edge of 'mesh' from 'values' (shape (E,))."""
+    values = np.asarray(values, dtype=np.float32)
+    import bpy
+    if bpy.app.version < (4, 0, 0):
+        mesh.edges.foreach_set("crease", values)
+    else:
+        attr = mesh.attributes.get("crease_edge")
+        if attr is None:
+            attr = mesh.attributes.new("crease_edge", 'FLOAT', 'EDGE')
+        attr.data.foreach_set("value", values)
+    mesh.update()
+
+def get_crease_values(mesh):
+    """Return the crease of every edge of 'mesh', shape (E,)."""
+    import bpy
+    values = np.zeros(len(mesh.edges), dtype=np.float32)
+    if bpy.app.version < (4, 0, 0):
+        mesh.edges.foreach_get("crease", values)
+    else:
+        attr = mesh.attributes.get("crease_edge")
+        if attr is not None:
+            attr.data.foreach_get("value", values)
+    return values
+
+def set_creases(mesh, pairs, crease_val):
+    """Set the crease to 'crease_val' on those *undirected* edges in
+    'pairs' (a set of (vi, vj) tuples, or an array of shape (M,2)), and
+    leave the rest as they were.  'crease_val' may also be an array of
+    shape (M,), giving each edge's crease."""
+    values = get_crease_values(mesh)
+    idx = edge_lookup(mesh_edges(mesh), pairs)
+    found = idx >= 0
+    values[found] = np.broadcast_to(crease_val, (len(pairs),))[idx[found]]
+    set_crease_values(mesh, values)
+
+def load_bundle(name, fname, crease=None, crease_val=1.0):
+    """Create a mesh from a bundle file (see meshbundle).  If 'crease'
+    names an edge attribute (e.g. "joint" for edge:joint), edges in the
+    bundle's 'edges' where it is nonzero get crease 'crease_val' - or,
+    if crease_val is None, the attribute's own value.
+
+    Returns (mesh, bundle), the latter being all of the bundle's arrays
+    (memory-mapped) for any further use."""
+    bundle = meshbundle.read(fname)
+    mesh = new_mesh(name, bundle["verts"], *meshbundle.bundle_loops(bundle))
+    if crease is not None:
+        attr = bundle["edge:" + crease]
+        sel = attr != 0
+        vals = attr[sel] if crease_val is None else crease_val
+        set_creases(mesh, bundle["edges"][sel], vals)
+    return mesh, bundle
+
+def add_object(name, mesh):
+    """Make an object of 'mesh' and link it into the current scene."""
+    import bpy
+    obj = bpy.data.objects.new(name, mesh)
+    bpy.context.scene.collection.objects.link(obj)
+    return obj
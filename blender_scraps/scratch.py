@@ -16,6 +16,8 @@ def bmesh_set_creases(obj, vert_pairs, crease_val):
     # Walk through the edges in 'obj'. For those *undirected* edges in
     # 'vert_pairs' (a set of (vi, vj) tuples, where vi and vj are vertex
     # indices, and tuple order is irrelevant), set the crease to 'crease_val'.
+    # (This is slow for big meshes; meshload.set_creases does the same
+    # with a few array operations.)
     bm = bmesh.new()
     bm.from_mesh(obj)
     creaseLayer = bm.edges.layers.crease.verify()
@@ -66,6 +68,7 @@ for edge in me.edges:
 # Creating a mesh with vertices & faces in Python via bpy with:
 # v - list of (x, y, z) tuples
 # f - list of (v0, v1, v2...) tuples, each with face's vertex indices
+# (For big meshes, see meshload.new_mesh, which takes arrays instead.)
 mesh = bpy.data.meshes.new('mesh_thing')
 mesh.from_pydata(v, [], f)
 mesh.update(calc_edges=True)
@@ -4,6 +4,8 @@
 # - It doesn't yet do creases.
 
 import numpy as np
+import meshbuf
+import meshbundle
 import xform
 
 # Mnemonics:
@@ -46,33 +48,113 @@ class TreeThing(object):
             scale(0.5)
             for i in range(4)
         ]
-        # Face & vertex accumulators:
-        self.faces = []
-        # self.faces will be a list of tuples (each one of length 4
-        # and containing indices into self.verts)
-        self.verts = []
-        # self.verts will be a list of np.array of shape (3,) but will
-        # be converted last-minute to tuples. (Why: we need to refer
-        # to prior vertices and arithmetic is much easier from an
-        # array, but Blender eventually needs tuples.)
+        # Face & vertex accumulator (see meshbuf.MeshBuffer):
+        self.mesh = meshbuf.MeshBuffer()
         self.creases_side = set()
         self.creases_joint = set()
         self.depth = depth
 
     def run(self):
-        self.verts.extend(self.base)
-        self.faces.append((0, 1, 2, 3))
+        # Returns (verts, loops, loop_start, loop_total) arrays - see
+        # meshbuf.MeshBuffer.
+        self.mesh.add_verts(self.base)
+        self.mesh.add_faces([(0, 1, 2, 3)])
+        self.grow(xform.Transform(), self.depth, [0, 1, 2, 3])
+        return self.mesh.arrays()
+
+    def run_recursive(self):
+        # Same as run(), but with child() recursing one branch at a
+        # time.  (Vertices & faces come out in a different order.)
+        self.mesh.add_verts(self.base)
+        self.mesh.add_faces([(0, 1, 2, 3)])
         self.child(xform.Transform(), self.depth, [0, 1, 2, 3])
-        verts = [tuple(v) for v in self.verts]
-        faces = [tuple(f) for f in self.faces]
-        return verts, faces
+        return self.mesh.arrays()
+
+    def grow(self, xf: xform.Transform, depth, b):
+        # Breadth-first equivalent of self.child(xf, depth, b): rather
+        # than recursing, this handles every branch at the same level at
+        # once, with its transforms in one xform.TransformArray, and its
+        # 'depth' and 'b' as rows of arrays of shape (K,) and (K,4).
+        xfs = xform.TransformArray(xf.mtx[np.newaxis])
+        depths = np.array([depth])
+        bs = np.array([b])
+        while len(xfs):
+            xfs, depths, bs = self.child_level(xfs, depths, bs)
+
+    def child_level(self, xfs, depths, bs):
+        # Batched child(); returns (xfs, depths, bs) for the next level.
+        done = xfs.get_scale()[:, 0] < self.scale_min
+        # Note opposite winding order
+        self.mesh.add_faces(bs[done][:, [3,2,1,0]])
+        xfs2 = xfs[~done].compose(self.incr)
+        depths = depths[~done]
+        bs = bs[~done]
+        n = len(self.base)
+        i = np.arange(n)
+        j = (i + 1) % n
+        # Just continue on the current path where depth > 0:
+        cont = depths > 0
+        n0 = self.mesh.add_verts(xfs2[cont].apply_to(self.base))
+        n0 = n0 + n * np.arange(np.count_nonzero(cont))
+        # Connect parallel faces:
+        a = n0[:, np.newaxis] + i
+        b = bs[cont]
+        self.mesh.add_faces(np.stack([a, a[:, j], b[:, j], b], axis=-1)
+                            .reshape(-1, 4))
+        next_xfs = [xfs2[cont]]
+        next_depths = [depths[cont] - 1]
+        next_bs = [a]
+        # ...and split into 4 where it's 0:
+        split = ~cont
+        xfs_s = xfs2[split]
+        k = np.arange(len(xfs_s))
+        per = n + len(self.trans)
+        g = np.concatenate([xfs_s.apply_to(self.base),
+                            xfs_s.apply_to(self.trans)], axis=1)
+        base = self.mesh.add_verts(g) + per * k
+        b = bs[split]
+        nv = base[:, np.newaxis] + i
+        m01 = base + n
+        m12, m23, m30, c = m01 + 1, m01 + 2, m01 + 3, m01 + 4
+        self.mesh.add_faces(np.stack([
+            # two faces straddling edge from vertex 0:
+            (b[:, 0], nv[:, 0], m01),
+            (b[:, 0], m30, nv[:, 0]),
+            # two faces straddling edge from vertex 1:
+            (b[:, 1], nv[:, 1], m12),
+            (b[:, 1], m01, nv[:, 1]),
+            # two faces straddling edge from vertex 2:
+            (b[:, 2], nv[:, 2], m23),
+            (b[:, 2], m12, nv[:, 2]),
+            # two faces straddling edge from vertex 3:
+            (b[:, 3], nv[:, 3], m30),
+            (b[:, 3], m23, nv[:, 3]),
+            # four faces from edge (0,1), (1,2), (2,3), (3,0):
+            (b[:, 0], m01, b[:, 1]),
+            (b[:, 1], m12, b[:, 2]),
+            (b[:, 2], m23, b[:, 3]),
+            (b[:, 3], m30, b[:, 0]),
+        ], axis=0).transpose(2, 0, 1).reshape(-1, 3))
+        split_bs = [
+            (c, m12, nv[:, 2], m23),
+            (c, m01, nv[:, 1], m12),
+            (c, m30, nv[:, 0], m01),
+            (c, m23, nv[:, 3], m30),
+        ]
+        for s, sb in zip(self.splits, split_bs):
+            next_xfs.append(xfs_s.compose(s))
+            next_depths.append(np.full(len(xfs_s), self.depth))
+            next_bs.append(np.stack(sb, axis=-1))
+        return (xform.TransformArray.concat(next_xfs),
+                np.concatenate(next_depths),
+                np.concatenate(next_bs).reshape(-1, 4))
 
     def trunk(self, xf: xform.Transform, b):
 
         if self.limit_check(xf):
             # Note opposite winding order
             verts = [b[i] for i in [3,2,1,0]]
-            self.faces.append(verts)
+            self.mesh.add_faces([verts])
             return
 
         incr = (xform.Transform().
@@ -89,8 +171,7 @@ class TreeThing(object):
         ]
         xf2 = xf.compose(incr)
         g = xf2.apply_to(self.base)
-        a0 = len(self.verts)
-        self.verts.extend(g)
+        a0 = self.mesh.add_verts(g)
 
         # TODO: Turn this to a cleaner loop?
         self.main(iters - 1, xf2, [a0, a0 + 1, a0 + 2, a0 + 3])
@@ -103,6 +184,14 @@ class TreeThing(object):
         self.child(iters - 1, xf.compose(self.sides[3]),
                    [b[3], b[0], a0 + 0, a0 + 3])
 
+    def save_bundle(self, fname):
+        # Write the mesh from run(), and which edges are in
+        # creases_joint & creases_side (as edge:joint & edge:side), as a
+        # mesh bundle (see meshbundle and meshload.load_bundle).
+        edges, attrs = meshbundle.edge_sets(joint=self.creases_joint,
+                                            side=self.creases_side)
+        self.mesh.save_bundle(fname, edges=edges, **attrs)
+
     def limit_check(self, xf: xform.Transform) -> bool:
         # Assume all scales are the same (for now)
         sx,_,_ = xf.get_scale()
@@ -112,14 +201,13 @@ class TreeThing(object):
         if self.limit_check(xf):
             # Note opposite winding order
             verts = [b[i] for i in [3,2,1,0]]
-            self.faces.append(verts)
+            self.mesh.add_faces([verts])
             return
 
         xf2 = xf.compose(self.incr)
         if depth > 0:
             # Just recurse on the current path:
-            n0 = len(self.verts)
-            self.verts.extend(xf2.apply_to(self.base))
+            n0 = self.mesh.add_verts(xf2.apply_to(self.base))
 
             # Connect parallel faces:
             n = len(self.base)
@@ -128,16 +216,14 @@ class TreeThing(object):
                 b1 = b[j]
                 a0 = n0 + i
                 a1 = n0 + j
-                self.faces.append((a0, a1, b1, b0))
+                self.mesh.add_faces([(a0, a1, b1, b0)])
 
             self.child(xf2, depth - 1, [n0, n0 + 1, n0 + 2, n0 + 3]);
         else:
-            n = len(self.verts)
-            self.verts.extend(xf2.apply_to(self.base))
-            m01 = len(self.verts)
-            self.verts.extend(xf2.apply_to(self.trans))
+            n = self.mesh.add_verts(xf2.apply_to(self.base))
+            m01 = self.mesh.add_verts(xf2.apply_to(self.trans))
             m12, m23, m30, c = m01 + 1, m01 + 2, m01 + 3, m01 + 4
-            self.faces.extend([
+            self.mesh.add_faces([
                 # two faces straddling edge from vertex 0:
                 (b[0], n+0, m01),
                 (b[0], m30, n+0),
@@ -51,6 +51,52 @@ class Transform(object):
         norms = np.linalg.norm(self.mtx, axis=0)
         return norms[:3]
 
+class TransformArray(object):
+    """A stack of K transforms, held as one array of shape (K,4,4).
+
+    This has the same methods as Transform, but each acts on all K at
+    once; compose() accepts a Transform (composed with all of them) or
+    a TransformArray of length K (composed pairwise).
+    """
+    def __init__(self, mtx):
+        self.mtx = mtx
+    @classmethod
+    def Identity(cls, count):
+        return cls(np.tile(np.identity(4), (count, 1, 1)))
+    @classmethod
+    def concat(cls, arrays):
+        return cls(np.concatenate([a.mtx for a in arrays]))
+    def __len__(self):
+        return self.mtx.shape[0]
+    def __getitem__(self, idx):
+        # Index, slice, or mask; always gives back a TransformArray
+        return TransformArray(self.mtx[idx].reshape(-1, 4, 4))
+    def _compose(self, mtx2):
+        return TransformArray(np.matmul(self.mtx, mtx2))
+    def compose(self, xform):
+        return self._compose(xform.mtx)
+    def scale(self, *a, **kw):
+        return self._compose(mtx_scale(*a, **kw))
+    def translate(self, *a, **kw):
+        return self._compose(mtx_translate(*a, **kw))
+    def rotate(self, *a, **kw):
+        return self._compose(mtx_rotate(*a, **kw))
+    def reflect(self, *a, **kw):
+        return self._compose(mtx_reflect(*a, **kw))
+    def identity(self, *a, **kw):
+        return self._compose(mtx_identity(*a, **kw))
+    def apply_to(self, vs):
+        # vs has shape (N,3); returns shape (K,N,3), with transform k
+        # applied to all of vs in row k.  This splits the (affine) matrix
+        # into its 3x3 part and translation rather than appending ones.
+        a = self.mtx[:, :3, :3]
+        t = self.mtx[:, np.newaxis, :3, 3]
+        return np.matmul(vs, a.transpose(0, 2, 1)) + t
+    def get_scale(self):
+        # Shape (K,3), as for Transform.get_scale:
+        norms = np.linalg.norm(self.mtx, axis=1)
+        return norms[:, :3]
+
 def mtx_scale(sx, sy=None, sz=None):
     if sy is None:
         sy = sx
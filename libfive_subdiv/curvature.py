@@ -0,0 +1,250 @@
+# Curvature of an implicit surface across the edges of a mesh of it
+# (see test_subdiv.py).
+#
+# edge_curvature does every edge at once.  That needs a dozen or so
+# arrays the size of the edge list (midpoints, edge vectors,
+# perpendiculars, and the Dual's gradients & Hessians, which are 3 and
+# 6 times that), so at libfive resolutions of 200 and up it runs to
+# gigabytes, on one core.  edge_curvature_chunked instead does
+# fixed-size chunks of edges over a pool of worker processes, each
+# writing its chunk straight into one shared output array, so memory
+# is bounded by (chunk size) x (workers) however big the mesh is.
+# Every edge is computed independently, so the result is the same,
+# bit for bit, whatever the chunk size.
+
+import concurrent.futures
+import multiprocessing
+import resource
+import tracemalloc
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import dual
+
+def any_perpendicular(vecs):
+    # For 'vecs' of shape (..., 3), this returns an array of shape
+    # (..., 3) in which every corresponding vector is perpendicular
+    # (but nonzero).  'vecs' does not need to be normalized, and the
+    # returned vectors are not normalized.
+    x,y,z = [vecs[..., i] for i in range(3)]
+    a0 = np.zeros_like(x)
+    # The condition has the extra dimension added to make it (..., 1)
+    # so it broadcasts properly with the branches, which are (..., 3):
+    p = np.where((np.abs(z) < np.abs(x))[...,None],
+                 np.stack((y,  -x, a0), axis=-1),
+                 np.stack((a0, -z, y),  axis=-1))
+    return p
+
+def normal_curvature(grad, hess, u, v):
+    # For an implicit surface with gradient 'grad' (shape (..., 3)) and
+    # Hessian 'hess' (shape (..., 3, 3)) at some points, this returns
+    # the curvature at each point of the implicit curve made by cutting
+    # the surface with the plane through that point spanned by unit
+    # vectors 'u' and 'v' (shape (..., 3), perpendicular).
+    #
+    # This is what implicit_curvature_2d(intersect_implicit(...)) below
+    # gives at s=t=0, but the curve's derivatives there are just the
+    # surface's projected onto u & v (e.g. d/ds = grad.u, d2/dsdt =
+    # u.hess.v), so it's a few products rather than three passes of
+    # autograd.
+    hu = np.einsum("...ij,...j->...i", hess, u)
+    hv = np.einsum("...ij,...j->...i", hess, v)
+    ds  = np.sum(grad*u, axis=-1)
+    dt  = np.sum(grad*v, axis=-1)
+    dss = np.sum(u*hu, axis=-1)
+    dst = np.sum(u*hv, axis=-1)
+    dtt = np.sum(v*hv, axis=-1)
+    return (-dt*dt*dss + 2*ds*dt*dst - ds*ds*dtt) / ((ds*ds + dt*dt)**(3/2))
+
+# Reference versions of the above, by autograd (much slower; kept to
+# check against).  autograd is imported only when these are used, as
+# nothing else here needs it.
+
+def intersect_implicit(surface_fn):
+    # surface_fn(x,y,z)=0 is an implicit surface.  This returns a
+    # function f(s, t, pt, u, v) which - for f(s,t,...) = 0 is the
+    # implicit curve created by intersecting the surface with a plane
+    # passing through point 'pt' and with two perpendicular unit
+    # vectors 'u' and 'v' that lie on the plane.
+    def g(pts_2d, pt_center, u, v, **kw):
+        s,t = [pts_2d[..., i, None] for i in range(2)]
+        pt_3d = pt_center + s*u + t*v
+        return surface_fn(pt_3d, **kw)
+    return g
+
+def implicit_curvature_2d(curve_fn):
+    # Returns a function which computes curvature of an implicit
+    # curve, curve_fn(s,t)=0.  The resultant function takes two
+    # arguments as well.
+    #
+    # (This is slow: every egrad retraces curve_fn, and so the whole
+    # surface function, for every point and direction.  It is kept as a
+    # reference for normal_curvature.)
+    #
+    from autograd import elementwise_grad as egrad
+    # First derivatives:
+    _g1 = egrad(curve_fn)
+    # Second derivatives:
+    _g2s = egrad(lambda *a, **kw: _g1(*a, **kw)[...,0])
+    _g2t = egrad(lambda *a, **kw: _g1(*a, **kw)[...,1])
+    # Doing 'egrad' twice doesn't have the intended effect, so here I
+    # split up the first derivative manually.
+    def f(st, **kw):
+        g1  = _g1(st, **kw)
+        g2s = _g2s(st, **kw)
+        g2t = _g2t(st, **kw)
+        ds  = g1[..., 0]
+        dt  = g1[..., 1]
+        dss = g2s[..., 0]
+        dst = g2s[..., 1]
+        dtt = g2t[..., 1]
+        return (-dt*dt*dss + 2*ds*dt*dst - ds*ds*dtt) / ((ds*ds + dt*dt)**(3/2))
+    return f
+
+def implicit_grad_hess(surface_fn):
+    # Returns a function which, for points 'pts' of shape (..., 3),
+    # returns the gradient (..., 3) and Hessian (..., 3, 3) of
+    # surface_fn at every point (computed in double precision, whatever
+    # the type of 'pts').  dual.value_grad_hess does the same in one
+    # forward pass, and faster; this is kept to check it against.
+    #
+    # The gradient is traced just once; its vector-Jacobian product with
+    # each unit vector then gives a row of the Hessian, without tracing
+    # surface_fn again.
+    from autograd import make_vjp, elementwise_grad as egrad
+    _g1 = egrad(surface_fn)
+    def f(pts):
+        pts = pts.astype(np.float64)
+        vjp, g = make_vjp(_g1)(pts)
+        eye = np.eye(3)
+        h = np.stack([vjp(np.broadcast_to(eye[i], pts.shape)) for i in range(3)],
+                     axis=-2)
+        return g, h
+    return f
+
+def unique_edges(tris, nverts):
+    # For triangles 'tris' (shape (T,3), vertex indices below 'nverts'),
+    # returns (edges, tri_edge).  'edges' has shape (E,2) and has every
+    # undirected edge just once, lower vertex index first (and sorted).
+    # tri_edge[i,j] is the row of 'edges' that is triangle i's edge from
+    # its vertex j to vertex j+1.
+    a = np.asarray(tris, dtype=np.int64)
+    b = np.roll(a, -1, axis=1)
+    lo = np.minimum(a, b).ravel()
+    hi = np.maximum(a, b).ravel()
+    _, first, tri_edge = np.unique(lo*nverts + hi, return_index=True,
+                                   return_inverse=True)
+    edges = np.stack([lo[first], hi[first]], axis=1)
+    return edges, tri_edge.reshape(a.shape)
+
+def edge_curvature(surface_fn, verts, edges):
+    # For implicit surface 'surface_fn' (taking points of shape (..., 3),
+    # as spiral_implicit's f does), mesh vertices 'verts' (N,3) and
+    # 'edges' (E,2) of vertex indices, returns the curvature (E,) of the
+    # surface at each edge's midpoint, across that edge: in the plane
+    # perpendicular to it.
+    #
+    # Shape (E, 2, 3). Final axis is (x,y,z).
+    edge_verts = verts[edges]
+    vi, vj = edge_verts[:, 0, :], edge_verts[:, 1, :]
+    mids = (vi+vj)/2
+    # Compute normalized edge vectors:
+    diff = vj-vi
+    edge_vecs = diff/np.linalg.norm(diff, axis=1, keepdims=True)
+    # Find perpendicular to all edge vectors:
+    v1 = any_perpendicular(edge_vecs)
+    v1 /= np.linalg.norm(v1, axis=-1, keepdims=True)
+    # and perpendiculars to both:
+    v2 = np.cross(edge_vecs, v1)
+    # (Going along an edge the other way flips edge_vecs, v1, and the signs
+    # of the first derivatives below, but not the curvature.)
+    _, mid_grad, mid_hess = dual.value_grad_hess(surface_fn, mids)
+    return normal_curvature(mid_grad, mid_hess, v1, v2)
+
+# Inputs & output of the current edge_curvature_chunked call.  Worker
+# processes are forked after this is set, so they inherit it rather than
+# having it pickled (which surface functions, being closures, can't be),
+# and 'out' is shared memory, so what they write into it the parent sees.
+_work = {}
+
+def _do_chunk(e0, e1):
+    # Curvature of edges e0 to e1 into _work["out"]; returns the peak
+    # memory (bytes, per tracemalloc) this took, and the peak RSS (MiB)
+    # of this process so far.
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.start()
+    try:
+        cur, _ = tracemalloc.get_traced_memory()
+        _work["out"][e0:e1] = edge_curvature(
+            _work["surface_fn"], _work["verts"], _work["edges"][e0:e1])
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    peak -= cur
+    # (ru_maxrss is in KiB on Linux)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return peak, rss
+
+def edge_curvature_chunked(surface_fn, verts, edges, chunk=1<<16,
+                           workers=None, out=None):
+    # The same as edge_curvature(surface_fn, verts, edges), but done
+    # 'chunk' edges at a time, over up to 'workers' processes (default:
+    # one per CPU; 0 does the chunks in this process instead).  If 'out'
+    # is given (any writable array of E floats, e.g. np.memmap(...,
+    # mode="w+") to write a file), it's filled in and returned;
+    # otherwise a new array is returned.
+    #
+    # Returns (curvature, stats), where 'stats' is a dict with:
+    #   chunks     number of chunks
+    #   peak       largest memory (bytes) any one chunk took
+    #   rss        peak RSS (MiB) of the largest worker process (or of
+    #              this process, without workers)
+    if chunk < 1:
+        raise ValueError("chunk must be at least 1, not {}".format(chunk))
+    n = len(edges)
+    bounds = [(e0, min(e0 + chunk, n)) for e0 in range(0, n, chunk)]
+    shm = None
+    if workers == 0:
+        res = np.empty(n, dtype=np.float64) if out is None else out
+    else:
+        # Workers always write into shared memory: whatever they write
+        # into an ordinary array (even a memmap made with mode="r+" or
+        # "c") would only go to their own copy-on-write pages.
+        # (SharedMemory can't be zero bytes)
+        shm = shared_memory.SharedMemory(create=True, size=max(8*n, 1))
+        res = np.ndarray((n,), dtype=np.float64, buffer=shm.buf)
+    _work.update(surface_fn=surface_fn, verts=verts, edges=edges, out=res)
+    try:
+        if workers == 0:
+            results = [_do_chunk(e0, e1) for e0, e1 in bounds]
+        else:
+            ctx = multiprocessing.get_context("fork")
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers, mp_context=ctx) as pool:
+                futures = [pool.submit(_do_chunk, e0, e1) for e0, e1 in bounds]
+                results = [fut.result() for fut in futures]
+        if shm is None:
+            k = res
+        elif out is None:
+            k = res.copy()
+        else:
+            out[...] = res
+            k = out
+    finally:
+        _work.clear()
+        if shm is not None:
+            # (close() fails while any array still uses shm.buf)
+            res = None
+            shm.close()
+            shm.unlink()
+    stats = {
+        "chunks": len(bounds),
+        "peak": max([p for p, _ in results], default=0),
+        "rss": max([r for _, r in results], default=0.0),
+    }
+    return k, stats
@@ -0,0 +1,302 @@
+# Forward-mode automatic differentiation, to second order, over NumPy
+# arrays.
+#
+# A Dual holds, for every element of an array of values, the value
+# itself plus its gradient and Hessian with respect to some n input
+# variables (n=3 for x,y,z):
+#
+#   val  -- shape S
+#   grad -- shape (n,) + S
+#   hess -- shape (m,) + S, with m = n*(n+1)/2: as the Hessian is
+#           symmetric, only entries (i,j) with i <= j are kept, in the
+#           order of _pairs(n).  None means all zero (e.g. for the
+#           inputs themselves, or anything linear in them).
+#
+# (Derivatives go first so that arithmetic on them is over long
+# contiguous arrays of shape S, not many tiny axes of size n.)
+#
+# Arithmetic and the NumPy ufuncs below (np.sin etc.) on a Dual carry
+# all three along by the chain rule, so running a function once on
+# seed(pts) gives its value, gradient and Hessian at every point.  For
+# a function of few inputs, like an implicit surface f(x,y,z), this is
+# one pass over plain arrays, with none of the tracing that reverse mode
+# (autograd) does on every call.
+#
+# For example, with spiral_implicit from test_subdiv.py:
+#
+#     f, g = spiral_implicit(2.0, 0.4, 20.0, 0.0, 0.3)
+#     val, grad, hess = dual.value_grad_hess(f, pts)   # pts: (N,3)
+#
+# Functions need only use arithmetic, indexing, and the ufuncs listed in
+# _unary and _binary.  That includes autograd.numpy's versions, which
+# just pass a Dual on to NumPy.
+
+import functools
+
+import numpy as np
+
+class Dual(object):
+    def __init__(self, val, grad, hess=None):
+        self.val = val
+        self.grad = grad
+        self.hess = hess
+    @property
+    def shape(self):
+        return np.shape(self.val)
+    @property
+    def ndim(self):
+        return np.ndim(self.val)
+    def __len__(self):
+        return len(self.val)
+    def __getitem__(self, idx):
+        # Index everything after the derivative axis:
+        if not isinstance(idx, tuple):
+            idx = (idx,)
+        didx = (slice(None),) + idx
+        hess = None if self.hess is None else self.hess[didx]
+        return Dual(self.val[idx], self.grad[didx], hess)
+    def __repr__(self):
+        return "Dual(val={!r}, grad={!r}, hess={!r})".format(
+            self.val, self.grad, self.hess)
+
+    # Arithmetic goes through the same ufunc code as np.add etc.:
+    def __add__(self, other):
+        return np.add(self, other)
+    def __radd__(self, other):
+        return np.add(other, self)
+    def __sub__(self, other):
+        return np.subtract(self, other)
+    def __rsub__(self, other):
+        return np.subtract(other, self)
+    def __mul__(self, other):
+        return np.multiply(self, other)
+    def __rmul__(self, other):
+        return np.multiply(other, self)
+    def __truediv__(self, other):
+        return np.true_divide(self, other)
+    def __rtruediv__(self, other):
+        return np.true_divide(other, self)
+    def __pow__(self, other):
+        return np.power(self, other)
+    def __rpow__(self, other):
+        return np.power(other, self)
+    def __neg__(self):
+        return np.negative(self)
+    def __pos__(self):
+        return self
+    def __abs__(self):
+        return np.absolute(self)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kw):
+        if method != "__call__" or kw:
+            return NotImplemented
+        if len(inputs) == 1 and ufunc in _unary:
+            return _chain(inputs[0], *_unary[ufunc](inputs[0].val))
+        if len(inputs) == 2 and ufunc in _binary:
+            return _binary[ufunc](*inputs)
+        return NotImplemented
+
+@functools.lru_cache()
+def _pairs(n):
+    # Row & column of each Hessian entry that is kept:
+    return np.triu_indices(n)
+
+def seed(pts):
+    """Return a Dual for points 'pts' (shape (..., n)) as the n input
+    variables themselves: pts[..., i] has gradient e_i and Hessian 0."""
+    pts = np.asarray(pts, dtype=np.float64)
+    n = pts.shape[-1]
+    eye = np.eye(n).reshape((n,) + (1,)*(pts.ndim - 1) + (n,))
+    return Dual(pts, np.broadcast_to(eye, (n,) + pts.shape))
+
+def value_grad_hess(fn, pts):
+    """Evaluate fn at points 'pts' (shape (..., n)).  fn should take
+    such an array and return one value per point.  Returns (value,
+    gradient, Hessian) with shapes (...), (..., n), (..., n, n)."""
+    pts = np.asarray(pts, dtype=np.float64)
+    n = pts.shape[-1]
+    d = fn(seed(pts))
+    if not isinstance(d, Dual):
+        # (fn didn't depend on its input at all)
+        d = _lift(np.broadcast_to(d, pts.shape[:-1]), n)
+    hess = np.zeros(d.shape + (n, n))
+    if d.hess is not None:
+        i, j = _pairs(n)
+        h = np.moveaxis(d.hess, 0, -1)
+        hess[..., i, j] = h
+        hess[..., j, i] = h
+    return d.val, np.moveaxis(d.grad, 0, -1), hess
+
+def _outer(a, b):
+    # Kept entries of a b^T + b a^T, for gradients a & b:
+    i, j = _pairs(a.shape[0])
+    return a[i]*b[j] + a[j]*b[i]
+
+def _chain(x, f, df, d2f):
+    # Given f(x.val) and its first & second derivatives, the Dual of
+    # f(x):
+    i, j = _pairs(x.grad.shape[0])
+    hess = d2f * x.grad[i] * x.grad[j]
+    if x.hess is not None:
+        hess += df * x.hess
+    return Dual(f, df * x.grad, hess)
+
+def _sqrt(a):
+    r = np.sqrt(a)
+    return r, 0.5 / r, -0.25 / (r * a)
+
+def _recip(a):
+    r = 1.0 / a
+    return r, -r*r, 2*r*r*r
+
+def _log(a):
+    r = 1.0 / a
+    return np.log(a), r, -r*r
+
+def _exp(a):
+    e = np.exp(a)
+    return e, e, e
+
+def _sin(a):
+    s = np.sin(a)
+    return s, np.cos(a), -s
+
+def _cos(a):
+    c = np.cos(a)
+    return c, -np.sin(a), -c
+
+def _tan(a):
+    t = np.tan(a)
+    s = 1 + t*t
+    return t, s, 2*t*s
+
+def _tanh(a):
+    t = np.tanh(a)
+    s = 1 - t*t
+    return t, s, -2*t*s
+
+def _arctan(a):
+    r = 1.0 / (1 + a*a)
+    return np.arctan(a), r, -2*a*r*r
+
+# ufunc -> function of x giving (f(x), f'(x), f''(x)):
+_unary = {
+    np.negative: lambda a: (-a, np.full_like(a, -1.0), np.zeros_like(a)),
+    np.positive: lambda a: (a, np.ones_like(a), np.zeros_like(a)),
+    np.square: lambda a: (a*a, 2*a, np.full_like(a, 2.0)),
+    np.sqrt: _sqrt,
+    np.reciprocal: _recip,
+    np.exp: _exp,
+    np.log: _log,
+    np.sin: _sin,
+    np.cos: _cos,
+    np.tan: _tan,
+    np.sinh: lambda a: (np.sinh(a), np.cosh(a), np.sinh(a)),
+    np.cosh: lambda a: (np.cosh(a), np.sinh(a), np.cosh(a)),
+    np.tanh: _tanh,
+    np.arctan: _arctan,
+    # (Not differentiable at 0, where this takes the derivative as 0)
+    np.absolute: lambda a: (np.abs(a), np.sign(a), np.zeros_like(a)),
+}
+
+def _lift(x, n):
+    # A constant as a Dual (of n variables) with zero derivatives:
+    x = np.asarray(x, dtype=np.float64)
+    return Dual(x, np.zeros((n,) + x.shape))
+
+def _expand(d, ndim):
+    # Dual 'd' with extra leading axes (of size 1) on its values, up to
+    # 'ndim' dimensions: what broadcasting does to values, but which
+    # has to be done by hand for derivatives, as theirs come first.
+    k = ndim - d.ndim
+    if k <= 0:
+        return d
+    shape = (1,)*k + d.shape
+    hess = d.hess
+    if hess is not None:
+        hess = hess.reshape(hess.shape[:1] + shape)
+    return Dual(np.reshape(d.val, shape),
+                d.grad.reshape(d.grad.shape[:1] + shape), hess)
+
+def _ndim(a, b):
+    return max(np.ndim(a.val if isinstance(a, Dual) else a),
+               np.ndim(b.val if isinstance(b, Dual) else b))
+
+def _broadcast(d, shape):
+    # Dual 'd' broadcast so its values have shape 'shape':
+    n = d.grad.shape[0]
+    hess = d.hess
+    if hess is not None:
+        hess = np.broadcast_to(hess, hess.shape[:1] + shape)
+    return Dual(np.broadcast_to(d.val, shape),
+                np.broadcast_to(d.grad, (n,) + shape), hess)
+
+def _add(a, b, sign=1):
+    nd = _ndim(a, b)
+    if isinstance(a, Dual):
+        a = _expand(a, nd)
+    if isinstance(b, Dual):
+        b = _expand(b, nd)
+    if not isinstance(a, Dual):
+        # constant +/- Dual:
+        if sign < 0:
+            b = -b
+        return _broadcast(Dual(a + b.val, b.grad, b.hess),
+                          np.broadcast(a, b.val).shape)
+    if not isinstance(b, Dual):
+        return _broadcast(Dual(a.val + sign*b, a.grad, a.hess),
+                          np.broadcast(a.val, b).shape)
+    if a.hess is None:
+        hess = None if b.hess is None else sign*b.hess
+    elif b.hess is None:
+        hess = a.hess
+    else:
+        hess = a.hess + sign*b.hess
+    return Dual(a.val + sign*b.val, a.grad + sign*b.grad, hess)
+
+def _mul(a, b):
+    if not isinstance(a, Dual):
+        a, b = b, a
+    nd = _ndim(a, b)
+    a = _expand(a, nd)
+    if not isinstance(b, Dual):
+        # Dual times constant:
+        b = np.asarray(b)
+        return Dual(a.val * b, a.grad * b,
+                    None if a.hess is None else a.hess * b)
+    b = _expand(b, nd)
+    hess = _outer(a.grad, b.grad)
+    if a.hess is not None:
+        hess += b.val * a.hess
+    if b.hess is not None:
+        hess += a.val * b.hess
+    return Dual(a.val * b.val, a.val * b.grad + b.val * a.grad, hess)
+
+def _div(a, b):
+    if not isinstance(b, Dual):
+        return _mul(a, 1.0 / np.asarray(b, dtype=np.float64))
+    return _mul(a, np.reciprocal(b))
+
+def _power(a, b):
+    if not isinstance(b, Dual):
+        # Constant exponent:
+        p = np.asarray(b, dtype=np.float64)
+        x = a.val
+        # (where a derivative's coefficient is 0, it's 0 even at x=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            d1 = np.where(p == 0, 0.0, p * x**(p-1))
+            d2 = np.where(p*(p-1) == 0, 0.0, p*(p-1) * x**(p-2))
+        return _chain(a, x**p, d1, d2)
+    if not isinstance(a, Dual):
+        # Constant base:
+        return np.exp(b * np.log(np.asarray(a, dtype=np.float64)))
+    # a**b = exp(b*log(a)):
+    return np.exp(b * np.log(a))
+
+_binary = {
+    np.add: _add,
+    np.subtract: lambda a, b: _add(a, b, -1),
+    np.multiply: _mul,
+    np.true_divide: _div,
+    np.power: _power,
+}
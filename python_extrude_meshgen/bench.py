@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+# Benchmarks for meshutil/quat kernels and for the models in examples.py.
+#
+# Microbenchmarks time each kernel over a range of boundary sizes (and
+# layer counts, where that applies).  End-to-end benchmarks run each
+# example, recording wall time, triangles per second, peak traced
+# memory, and the number of blocks still live (per tracemalloc) when
+# it returns - mostly the mesh itself, not everything allocated on the
+# way.  Examples that return an InstancedMesh are expanded
+# (to_mesh) inside both the timed and the traced run, so their figures
+# still compare with a plain mesh; the time before expansion is recorded
+# too, as instanced_seconds.  Results are saved as
+# JSON, and two such files can be compared:
+#
+#   ./bench.py -o before.json
+#   (change something)
+#   ./bench.py -o after.json
+#   ./bench.py --compare before.json after.json
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+import meshutil
+import quat
+import examples
+
+boundary_sizes = [4, 16, 64, 256, 1024, 4096]
+layer_counts = [2, 16, 128]
+
+def time_fn(fn, min_time=0.02, repeat=3):
+    # Seconds per call of fn(): calls it enough times in a row to take
+    # at least 'min_time', does that 'repeat' times, and takes the best.
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        dt = time.perf_counter() - t0
+        if dt >= min_time:
+            break
+        number *= 2
+    best = dt
+    for _ in range(repeat - 1):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, time.perf_counter() - t0)
+    return best / number
+
+def boundary(n):
+    # A circle of n points in XZ:
+    a = numpy.linspace(0, 2*numpy.pi, n, endpoint=False)
+    return numpy.stack([numpy.cos(a), numpy.zeros(n), numpy.sin(a)], axis=-1)
+
+def micro_cases():
+    # Yields (name, params, fn, elements) for every microbenchmark;
+    # 'elements' is how many vertices (or faces) one call processes.
+    xf = meshutil.Transform().scale(0.9).rotate([0,0,1], 0.3).translate(0,0,0.8)
+    sim = meshutil.Similarity.from_transform(xf)
+    # The quaternion kernels Transform.rotate itself uses (one rotation
+    # at a time), against Similarity's:
+    axis = numpy.array([0.0, 0.6, 0.8])
+    q1 = quat.rotation_quaternion(axis, 0.3)
+    yield "quat.rotation_quaternion", {}, lambda: quat.rotation_quaternion(axis, 0.3), 1
+    yield "quat.quat2mat", {}, lambda: quat.quat2mat(q1), 1
+    yield "Transform.rotate", {}, lambda: xf.rotate(axis, 0.3), 1
+    yield "Similarity.rotate", {}, lambda: sim.rotate(axis, 0.3), 1
+    for n in boundary_sizes:
+        b = boundary(n)
+        b2 = xf.apply_to(b)
+        p = {"n": n}
+        yield "Transform.apply_to", p, lambda: xf.apply_to(b), n
+        yield "Similarity.apply_to", p, lambda: sim.apply_to(b), n
+        yield "join_boundary_simple", p, lambda: meshutil.join_boundary_simple(b, b2), 2*n
+        yield "close_boundary_simple", p, lambda: meshutil.close_boundary_simple(b), n
+        m = meshutil.join_boundary_simple(b, b2)
+        yield "to_stl_records", p, m.to_stl_records, m.f.shape[0]
+        q = numpy.random.default_rng(0).normal(size=(n, 4))
+        q /= numpy.linalg.norm(q, axis=1, keepdims=True)
+        yield "quat.qmul", p, lambda: quat.qmul(q, q), n
+        yield "quat.qmat3", p, lambda: quat.qmat3(q), n
+        yield "quat.qrotate", p, lambda: quat.qrotate(q, b), n
+        yield "quat.conjugate_by", p, lambda: quat.conjugate_by(b, q1), n
+        for layers in layer_counts:
+            p = {"n": n, "layers": layers}
+            xfs = meshutil.sweep(meshutil.Transform(), xf, layers)
+            stack = xfs.apply_to(b)
+            meshes = [meshutil.join_boundary_simple(b0, b1)
+                      for b0, b1 in zip(stack, stack[1:])]
+            sims = meshutil.Similarity.from_transform(xfs)
+            yield "sweep", p, lambda: meshutil.sweep(meshutil.Transform(), xf, layers), layers
+            yield "TransformArray.apply_to", p, lambda: xfs.apply_to(b), n*layers
+            yield "TransformArray.compose", p, lambda: xfs.compose(xfs), layers
+            yield "Similarity.compose", p, lambda: sims.compose(sims), layers
+            yield "join_boundary_stack", p, lambda: meshutil.join_boundary_stack(stack), n*layers
+            yield "concat_many", p, lambda: meshutil.FaceVertexMesh.concat_many(meshes), n*layers
+            whole = meshutil.FaceVertexMesh.concat_many(meshes)
+            yield "FaceVertexMesh.weld", p, lambda: whole.weld(1e-6), whole.v.shape[0]
+
+def run_micro(pattern=None):
+    results = []
+    for name, params, fn, elements in micro_cases():
+        if pattern and pattern not in name:
+            continue
+        dt = time_fn(fn)
+        results.append({
+            "kind": "micro",
+            "name": name,
+            "params": params,
+            "seconds": dt,
+            "elements_per_second": elements / dt,
+        })
+        print("{:<26} {:<28} {:>12.3e} s".format(name, json.dumps(params), dt))
+    return results
+
+def build(fn):
+    # Returns (mesh, dt): the mesh from example function 'fn', and if
+    # that was an InstancedMesh (which this expands), the seconds 'fn'
+    # took before expansion (else None).
+    t0 = time.perf_counter()
+    mesh = fn()
+    if not isinstance(mesh, meshutil.InstancedMesh):
+        return mesh, None
+    dt = time.perf_counter() - t0
+    return mesh.to_mesh(), dt
+
+def run_e2e(pattern=None):
+    results = []
+    for name, (fn, _) in examples.outputs.items():
+        if pattern and pattern not in name:
+            continue
+        # Timing run, without tracemalloc's overhead:
+        t0 = time.perf_counter()
+        mesh, dt_inst = build(fn)
+        dt = time.perf_counter() - t0
+        nf = mesh.nf
+        nv = mesh.nv
+        del mesh
+        # Memory run:
+        tracemalloc.start()
+        mesh, _ = build(fn)
+        snap = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        live = sum(s.count for s in snap.statistics("filename"))
+        del mesh
+        results.append({
+            "kind": "e2e",
+            "name": name,
+            "params": {},
+            "seconds": dt,
+            "verts": nv,
+            "faces": nf,
+            "triangles_per_second": nf / dt,
+            "peak_bytes": peak,
+            "live_blocks": live,
+        })
+        line = "{:<26} {:>9.3f} s {:>12.0f} tri/s {:>9.1f} MiB peak".format(
+            name, dt, nf / dt, peak / 2**20)
+        if dt_inst is not None:
+            results[-1]["instanced_seconds"] = dt_inst
+            line += " ({:.3f} s instanced)".format(dt_inst)
+        print(line)
+    return results
+
+def compare(fname_a, fname_b):
+    # Print the ratio b/a of time (and peak memory) for every benchmark
+    # in both files.
+    def load(fname):
+        with open(fname) as fd:
+            data = json.load(fd)
+        return {(r["kind"], r["name"], json.dumps(r["params"], sort_keys=True)): r
+                for r in data["results"]}
+    a = load(fname_a)
+    b = load(fname_b)
+    print("{:<5} {:<26} {:<28} {:>12} {:>12} {:>7}".format(
+        "kind", "name", "params", "before (s)", "after (s)", "ratio"))
+    for key in a:
+        if key not in b:
+            continue
+        kind, name, params = key
+        ta = a[key]["seconds"]
+        tb = b[key]["seconds"]
+        line = "{:<5} {:<26} {:<28} {:>12.3e} {:>12.3e} {:>7.2f}".format(
+            kind, name, params, ta, tb, tb / ta)
+        if "peak_bytes" in a[key] and "peak_bytes" in b[key]:
+            line += "  mem {:.2f}".format(b[key]["peak_bytes"] / a[key]["peak_bytes"])
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark meshutil and examples")
+    parser.add_argument("-o", "--output", default="bench_results.json",
+                        help="JSON file to write results to")
+    parser.add_argument("-k", "--filter", default=None,
+                        help="Only run benchmarks whose name contains this")
+    parser.add_argument("--micro", action="store_true",
+                        help="Run only microbenchmarks")
+    parser.add_argument("--e2e", action="store_true",
+                        help="Run only end-to-end benchmarks")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="Compare two results files instead of running")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    results = []
+    if not args.e2e:
+        results += run_micro(args.filter)
+    if not args.micro:
+        results += run_e2e(args.filter)
+    data = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version,
+        "numpy": numpy.__version__,
+        "platform": platform.platform(),
+        "results": results,
+    }
+    with open(args.output, "w") as fd:
+        json.dump(data, fd, indent=1)
+    print("Wrote {} results to {}".format(len(results), args.output))
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 import itertools
 
 import meshutil
-import stl.mesh
+import prof
 import numpy
 
 class Cage(object):
@@ -43,6 +43,16 @@ class Cage(object):
                 yield self.verts[n0:n1,:]
             else:
                 yield self.verts[n0:,:]
+    def edges(self):
+        """Return every edge of every polygon (each one cyclic) as two
+        arrays of shape (E,3), of the start and end vertices."""
+        n = self.verts.shape[0]
+        nxt = numpy.arange(1, n + 1)
+        ends = list(self.splits[1:]) + [n]
+        for n0, n1 in zip(self.splits, ends):
+            if n1 > n0:
+                nxt[n1 - 1] = n0
+        return self.verts, self.verts[nxt]
     def subdivide_deprecated(self):
         # assume self.verts has shape (4,3).
         # Midpoints of every segment:
@@ -104,51 +114,76 @@ class Cage(object):
              case 1 does not apply.
         3 -- X equals a vertex in self.verts.
         """
-        v = [numpy.zeros((cage.verts.shape[0],), dtype=numpy.uint8)
-             for cage in cages]
-        # for cage i of all the cages...
-        for i, cage in enumerate(cages):
-            # for vertex j within cage i...
-            for j, vert in enumerate(cage.verts):
-                # Check against every vert in our own (self.verts):
-                for vert2 in self.verts:
-                    if numpy.allclose(vert, vert2):
-                        v[i][j] = 3
-                        break
-                if v[i][j] > 0:
-                    continue
-                # Check against every edge of our own polygons:
-                for poly in self.polys():
-                    for k,_ in enumerate(poly):
-                        # Below is because 'poly' is cyclic (last vertex
-                        # has an edge to the first):
-                        k2 = (k + 1) % len(poly)
-                        # Find distance from 'vert' to each vertex of the edge:
-                        d1 = numpy.linalg.norm(poly[k,:] - vert)
-                        d2 = numpy.linalg.norm(poly[k2,:] - vert)
-                        # Find the edge's length:
-                        d = numpy.linalg.norm(poly[k2,:] - poly[k,:])
-                        # These are equal if and only if the vertex lies along
-                        # that edge:
-                        if numpy.isclose(d, d1 + d2):
-                            v[i][j] = 1
-                            break
-                    if v[i][j] > 0:
-                        break
-                if v[i][j] > 0:
-                    continue
-                # Check against every *other* vert in cages:
-                for i2, cage2 in enumerate(cages):
-                    for j2, vert2 in enumerate(cage.verts):
-                        if i == i2 and j == j2:
-                            # same cage, same vertex - ignore:
-                            continue
-                        if numpy.allclose(vert, vert2):
-                            v[i][j] = 2
-                            break
-                    if v[i][j] > 0:
-                        break
-        return v
+        if not cages:
+            return []
+        sizes = [cage.verts.shape[0] for cage in cages]
+        pts = numpy.concatenate([cage.verts for cage in cages])
+        # Each test below is the same as numpy.allclose/numpy.isclose on
+        # one pair at a time, but only for the candidate pairs that
+        # _box_query finds (boxes a bit larger than the tolerance).
+        # Case 3, equal to a vertex of ours:
+        tol = 1e-8 + 1e-5 * numpy.abs(self.verts)
+        i, k = _box_query(pts, self.verts - 2*tol, self.verts + 2*tol)
+        ok = numpy.all(numpy.abs(pts[i] - self.verts[k]) <= tol[k], axis=1)
+        on_vert = numpy.zeros(pts.shape[0], dtype=bool)
+        on_vert[i[ok]] = True
+        # Case 1, on one of our edges - meaning that the distances to its
+        # ends add up to its length:
+        e0, e1 = self.edges()
+        d = numpy.linalg.norm(e1 - e0, axis=1)
+        # Those distances add up to at most smax (by the tolerance of
+        # isclose), which bounds how far a point can be from the edge:
+        smax = (d + 1e-8) / (1 - 1e-5)
+        r = 2 * numpy.sqrt(smax**2 - d**2)[:, numpy.newaxis] + 1e-8
+        i, k = _box_query(pts, numpy.minimum(e0, e1) - r,
+                          numpy.maximum(e0, e1) + r)
+        d1 = numpy.linalg.norm(e0[k] - pts[i], axis=1)
+        d2 = numpy.linalg.norm(e1[k] - pts[i], axis=1)
+        ok = numpy.isclose(d[k], d1 + d2)
+        on_edge = numpy.zeros(pts.shape[0], dtype=bool)
+        on_edge[i[ok]] = True
+        # Case 2, equal to some other vertex in 'cages':
+        tol = 1e-8 + 1e-5 * numpy.abs(pts)
+        i, k = _box_query(pts, pts - 2*tol, pts + 2*tol)
+        ok = numpy.all(numpy.abs(pts[i] - pts[k]) <= tol[k], axis=1) & (i != k)
+        shared = numpy.zeros(pts.shape[0], dtype=bool)
+        shared[i[ok]] = True
+        c = numpy.select([on_vert, on_edge, shared], [3, 1, 2], 0)
+        return numpy.split(c.astype(numpy.uint8), numpy.cumsum(sizes)[:-1])
+
+def _box_query(pts, lo, hi):
+    # Finds every point of 'pts' (shape (N,3)) inside every axis-aligned
+    # box given by corners 'lo' and 'hi' (both shape (K,3)), and returns
+    # them as index arrays (i, k): point pts[i] is inside box k.  Points
+    # are hashed to a grid with cells as big as the biggest box, so each
+    # box looks only at the points in the (at most 2x2x2) cells it
+    # overlaps, whatever their layout (e.g. all in one plane).
+    if pts.shape[0] == 0 or lo.shape[0] == 0:
+        return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int)
+    size = numpy.max(hi - lo)
+    if not size > 0:
+        size = 1.0
+    keys = meshutil.cell_key(numpy.floor(pts / size).astype(numpy.int64))
+    order = numpy.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    c0 = numpy.floor(lo / size).astype(numpy.int64)
+    c1 = numpy.floor(hi / size).astype(numpy.int64)
+    i = []
+    k = []
+    for off in itertools.product((0, 1), repeat=3):
+        # Boxes that reach the cell at 'off' from their 'lo' corner's:
+        c = c0 + off
+        boxes = numpy.flatnonzero(numpy.all(c <= c1, axis=1))
+        nbr = meshutil.cell_key(c[boxes])
+        m, pos = meshutil.expand_ranges(
+            numpy.searchsorted(sorted_keys, nbr, "left"),
+            numpy.searchsorted(sorted_keys, nbr, "right"))
+        i.append(order[pos])
+        k.append(boxes[m])
+    i = numpy.concatenate(i)
+    k = numpy.concatenate(k)
+    inside = numpy.all((pts[i] >= lo[k]) & (pts[i] <= hi[k]), axis=1)
+    return i[inside], k[inside]
 
 class CageFork(object):
     """A series of generators that all split off in such a way that their
@@ -191,10 +226,29 @@ class CageFork(object):
         self.edges = edges
     def is_fork(self):
         return True
-    def transition_from(self, cage):
-        """Generate a transitional mesh to adapt the given starting Cage"""
+    def check(self, cages):
+        """Check that the given Cages (the first of each generator in
+        'gens') fit this fork: that every vertex in them lies on our
+        transition cage - at a vertex or along an edge - or is shared
+        with another of them.  Raises ValueError if not."""
+        trans = Cage(self.verts, [0])
+        for i, c in enumerate(trans.classify_overlap(cages)):
+            bad = numpy.flatnonzero(c == 0)
+            if bad.size:
+                raise ValueError(
+                    "CageFork: vertices {} of cage {} are neither on the "
+                    "transition cage nor shared".format(list(bad), i))
+    @prof.counted("CageFork.transition_from",
+                  lambda self, cage, *a, **kw: len(cage.verts) + len(self.verts))
+    def transition_from(self, cage, builder=None, cage_idx=None):
+        """Generate a transitional mesh to adapt the given starting Cage.
+
+        If 'builder' (a meshutil.MeshBuilder) is given, this instead adds
+        the transition to it, with vertices shared: 'cage_idx' gives the
+        indices of cage.verts (already in 'builder'), and only our own
+        'verts' are added.  Their indices are returned.
+        """
         #print("DEBUG: Transition from {} to {}".format(cage.verts, self.verts))
-        vs = numpy.concatenate([cage.verts, self.verts])
         # Indices 0...offset-1 are from cage, rest are from self.verts
         offset = cage.verts.shape[0]
         # We have one face for total sub-elements in self.edges:
@@ -209,7 +263,67 @@ class CageFork(object):
                 face_idx += 1
             fs[face_idx] = [j, (j + 1) % len(cage.verts), offset + adjs[-1]]
             face_idx += 1
-        return meshutil.FaceVertexMesh(vs, fs)
+        if builder is None:
+            vs = numpy.concatenate([cage.verts, self.verts])
+            return meshutil.FaceVertexMesh(vs, fs)
+        trans_idx = builder.add_stack(self.verts[numpy.newaxis])[0]
+        builder.add_faces(numpy.concatenate([cage_idx, trans_idx])[fs])
+        return trans_idx
+
+def _match_verts(verts, known, tol):
+    # For each row of 'verts', finds the nearest row of 'known' (shape
+    # (K,3)) within tol*(1+|v|) of it.  Rows without one are new, except
+    # that one within that of an earlier new row is the same vertex as
+    # it.  Returns (idx, new): 'new' gives the rows of 'verts' that are
+    # new, and idx[i] the row for verts[i] in known + verts[new] (i.e.
+    # numpy.concatenate([known, verts[new]])).  This is all at once, with
+    # one distance matrix against 'known' and one among the rest.
+    n = verts.shape[0]
+    lim = tol * (1 + numpy.linalg.norm(verts, axis=1))
+    idx = numpy.full(n, -1)
+    if known.shape[0]:
+        d = numpy.linalg.norm(verts[:, numpy.newaxis] - known[numpy.newaxis], axis=2)
+        j = numpy.argmin(d, axis=1)
+        hit = d[numpy.arange(n), j] <= lim
+        idx[hit] = j[hit]
+    rest = numpy.flatnonzero(idx < 0)
+    if rest.size == 0:
+        return idx, rest
+    vr = verts[rest]
+    d = numpy.linalg.norm(vr[:, numpy.newaxis] - vr[numpy.newaxis], axis=2)
+    m = numpy.arange(rest.shape[0])
+    # The first earlier row that's close enough, or itself:
+    same = (d <= lim[rest, numpy.newaxis]) & (m[numpy.newaxis] < m[:, numpy.newaxis])
+    first = numpy.where(same.any(axis=1), same.argmax(axis=1), m)
+    # (That row may itself be a repeat of one before, and so on:)
+    while True:
+        f2 = first[first]
+        if numpy.array_equal(f2, first):
+            break
+        first = f2
+    is_new = first == m
+    new_pos = numpy.cumsum(is_new) - 1
+    idx[rest] = known.shape[0] + new_pos[first]
+    return idx, rest[is_new]
+
+def _share_verts(builder, verts, known, tol=1e-8):
+    # Returns an index (into 'builder') for each row of 'verts': that of a
+    # vertex listed in 'known' at the same position if there is one, else
+    # that of a newly-added vertex - which is then appended to 'known'.
+    idx, new = _match_verts(verts, builder.to_mesh().v[known], tol)
+    vi = builder.add_verts(verts[new])
+    new_idx = list(range(vi, vi + new.shape[0]))
+    all_idx = numpy.array(known + new_idx, dtype=int)
+    known.extend(new_idx)
+    return all_idx[idx]
+
+def _count_new_verts(verts, known, tol=1e-8):
+    # Dry-run counterpart of _share_verts: 'known' is a list of positions
+    # (not indices).  Returns how many rows of 'verts' would be added as
+    # new vertices, and appends those to 'known'.
+    _, new = _match_verts(verts, numpy.array(known).reshape(-1, 3), tol)
+    known.extend(verts[new])
+    return new.shape[0]
 
 class CageGen(object):
     """A generator, finite or infinite, that produces objects of type Cage.
@@ -217,8 +331,34 @@ class CageGen(object):
     of a finite generator."""
     def __init__(self, gen):
         self.gen = gen
+    @prof.counted("CageGen.to_mesh")
     def to_mesh(self, count=None, flip_order=False, loop=False, close_first=False,
-                close_last=False, join_fn=meshutil.join_boundary_simple):
+                close_last=False, join_fn=meshutil.join_boundary_simple,
+                builder=None, shared=False, fork_idx=None, check_forks=False,
+                dry_run=False):
+        # If 'builder' (a meshutil.MeshBuilder) is given, geometry is added
+        # to it; forks pass theirs down so everything lands in one place.
+        #
+        # If 'shared' is True, every vertex is added only once and shared
+        # by all joins, caps and transitions touching it (this needs the
+        # default join_fn).  'fork_idx' is then a list of indices of
+        # vertices (e.g. a fork's transition vertices) which the first Cage
+        # should reuse where they coincide; it is extended with any new
+        # ones, so that sibling CageGen of a fork can share them too.
+        #
+        # If 'check_forks' is True, every CageFork is checked (see
+        # CageFork.check) against the first Cage of each of its generators.
+        #
+        # If 'dry_run' is True, nothing is built: this walks the Cages and
+        # forks just the same, but only adds up how many vertices & faces
+        # there would be, and their bounds, in a meshutil.MeshStats
+        # ('builder', if given) which it returns.
+        if shared and join_fn is not meshutil.join_boundary_simple:
+            raise ValueError("shared=True works only with join_boundary_simple")
+        if dry_run and join_fn is not meshutil.join_boundary_simple:
+            raise ValueError("dry_run=True works only with join_boundary_simple")
+        if builder is None:
+            builder = meshutil.MeshStats() if dry_run else meshutil.MeshBuilder()
         # Get 'opening' polygons of generator:
         cage_first = next(self.gen)
         #print("DEBUG: to_mesh(count={}), cage_first={}".format(count, cage_first.verts))
@@ -227,56 +367,149 @@ class CageGen(object):
         if cage_first.is_fork():
             # TODO: Can it be a fork? Does that make sense?
             raise Exception("First element in CageGen can't be a fork.")
-        cage_last = cage_first
-        meshes = []
-        # Close off the first polygon if necessary:
-        if close_first:
-            for poly in cage_first.polys():
-                meshes.append(meshutil.close_boundary_simple(poly))
-        # Generate all polygons from there and connect them:
+        # Gather all Cage from there (up to a fork, or 'count') so that
+        # each polygon's whole sweep can be joined at once:
         #print(self.gen)
+        cages = [cage_first]
+        fork = None
+        stopped = False
         for i, cage_cur in enumerate(self.gen):
-            #print("DEBUG: i={}, cage_cur={}, cage_last={}".format(i, cage_cur, cage_last.verts))
+            #print("DEBUG: i={}, cage_cur={}, cage_last={}".format(i, cage_cur, cages[-1].verts))
             #print("{}: {}".format(i, cage_cur))
             if count is not None and i >= count:
-                # We stop recursing here, so close things off if needed:
-                if close_last:
-                    for poly in cage_last.polys():
-                        meshes.append(meshutil.close_boundary_simple(poly, reverse=True))
-                    # TODO: Fix the winding order hack here.
+                stopped = True
                 break
-            # If it's a fork, then recursively generate all the geometry
-            # from them, depth-first:
             if cage_cur.is_fork():
-                # First, transition the cage properly:
-                mesh_trans = cage_cur.transition_from(cage_last)
-                meshes.append(mesh_trans)
-                # TODO: Clean up these recursive calls; parameters are ugly.
-                # Some of them also make no sense in certain combinations
-                # (e.g. loop with fork)
-                for gen in cage_cur.gens:
-                    m = gen.to_mesh(count=count - i, flip_order=flip_order, loop=loop,
-                                    close_first=False, close_last=close_last,
-                                    join_fn=join_fn)
-                    meshes.append(m)
                 # A fork can be only the final element, so disregard anything
                 # after one and just quit:
+                fork = (i, cage_cur)
                 break
-            if flip_order:
-                for b0,b1 in zip(cage_cur.polys(), cage_last.polys()):
-                    m = join_fn(b0, b1)
-                    meshes.append(m)
+            cages.append(cage_cur)
+        # (For prof, elements are Cage vertices taken from the generator)
+        prof.add_elements("CageGen.to_mesh", sum([c.verts.shape[0] for c in cages]))
+        cage_last = cages[-1]
+        if dry_run:
+            return self._tally(cages, fork, stopped, count, loop, close_first,
+                               close_last, builder, shared, fork_idx,
+                               check_forks)
+        verts = numpy.stack([c.verts for c in cages])
+        ends = list(cage_first.splits[1:]) + [verts.shape[1]]
+        polys = list(zip(cage_first.splits, ends))
+        if shared:
+            if fork_idx is None:
+                idx = builder.add_stack(verts)
             else:
-                for b0,b1 in zip(cage_cur.polys(), cage_last.polys()):
-                    m = join_fn(b1, b0)
-                    meshes.append(m)
-            cage_last = cage_cur
-        if loop:
-            for b0,b1 in zip(cage_last.polys(), cage_first.polys()):
-                if flip_order:
-                    m = join_fn(b1, b0)
-                else:
-                    m = join_fn(b0, b1)
-                meshes.append(m)
-        mesh = meshutil.FaceVertexMesh.concat_many(meshes)
-        return mesh
+                idx0 = _share_verts(builder, cage_first.verts, fork_idx)
+                idx = numpy.concatenate(
+                    [idx0[numpy.newaxis], builder.add_stack(verts[1:])])
+            idx_polys = [idx[:, n0:n1] for n0, n1 in polys]
+        # Close off the first polygon if necessary:
+        if close_first:
+            if shared:
+                for p in idx_polys:
+                    builder.close_idx(p[0])
+            else:
+                for poly in cage_first.polys():
+                    builder.close(poly)
+        # Connect them all:
+        if shared:
+            builder.join_idx(idx_polys, flip_order=flip_order, loop=loop)
+        elif join_fn is meshutil.join_boundary_simple:
+            stacks = [verts[:, n0:n1, :] for n0, n1 in polys]
+            builder.join_stack(stacks, flip_order=flip_order, loop=loop)
+        else:
+            for cage_prev, cage_cur in zip(cages, cages[1:]):
+                for b0,b1 in zip(cage_cur.polys(), cage_prev.polys()):
+                    if flip_order:
+                        m = join_fn(b0, b1)
+                    else:
+                        m = join_fn(b1, b0)
+                    builder.add(m)
+            if loop:
+                for b0,b1 in zip(cage_last.polys(), cage_first.polys()):
+                    if flip_order:
+                        m = join_fn(b1, b0)
+                    else:
+                        m = join_fn(b0, b1)
+                    builder.add(m)
+        if stopped and close_last:
+            # We stop recursing here, so close things off if needed:
+            if shared:
+                for p in idx_polys:
+                    builder.close_idx(p[-1], reverse=True)
+            else:
+                for poly in cage_last.polys():
+                    builder.close(poly, reverse=True)
+            # TODO: Fix the winding order hack here.
+        # If it's a fork, then recursively generate all the geometry
+        # from them, depth-first:
+        if fork is not None:
+            i, cage_cur = fork
+            if check_forks:
+                _check_fork(cage_cur)
+            # First, transition the cage properly:
+            if shared:
+                trans_idx = cage_cur.transition_from(
+                    cage_last, builder=builder, cage_idx=idx[-1])
+                fork_idx = list(trans_idx)
+            else:
+                mesh_trans = cage_cur.transition_from(cage_last)
+                builder.add(mesh_trans)
+                fork_idx = None
+            # TODO: Clean up these recursive calls; parameters are ugly.
+            # Some of them also make no sense in certain combinations
+            # (e.g. loop with fork)
+            for gen in cage_cur.gens:
+                gen.to_mesh(count=count - i, flip_order=flip_order, loop=loop,
+                            close_first=False, close_last=close_last,
+                            join_fn=join_fn, builder=builder, shared=shared,
+                            fork_idx=fork_idx, check_forks=check_forks)
+        return builder.to_mesh()
+    def _tally(self, cages, fork, stopped, count, loop, close_first,
+               close_last, stats, shared, fork_pos, check_forks):
+        # The rest of to_mesh(..., dry_run=True), once Cages are gathered.
+        # Rather than indices, 'fork_pos' has positions of the fork's
+        # vertices (see _count_new_verts).
+        for c in cages:
+            stats.see(c.verts)
+        cage_first = cages[0]
+        ends = list(cage_first.splits[1:]) + [cage_first.verts.shape[0]]
+        sizes = [n1 - n0 for n0, n1 in zip(cage_first.splits, ends)]
+        if shared:
+            if fork_pos is None:
+                stats.add_stack(sum(sizes), len(cages))
+            else:
+                stats.add(_count_new_verts(cage_first.verts, fork_pos), 0)
+                stats.add_stack(sum(sizes), len(cages) - 1)
+        for n in sizes:
+            if close_first:
+                stats.close(n, shared)
+            stats.join_stack(n, len(cages), loop=loop, shared=shared)
+            if stopped and close_last:
+                stats.close(n, shared)
+        if fork is not None:
+            i, cage_cur = fork
+            if check_forks:
+                _check_fork(cage_cur)
+            stats.see(cage_cur.verts)
+            # As in CageFork.transition_from:
+            nf = sum([len(e) for e in cage_cur.edges])
+            if shared:
+                stats.add(cage_cur.verts.shape[0], nf)
+                fork_pos = list(cage_cur.verts)
+            else:
+                stats.add(cages[-1].verts.shape[0] + cage_cur.verts.shape[0], nf)
+                fork_pos = None
+            for gen in cage_cur.gens:
+                gen.to_mesh(count=count - i, loop=loop, close_first=False,
+                            close_last=close_last, builder=stats,
+                            shared=shared, fork_idx=fork_pos,
+                            check_forks=check_forks, dry_run=True)
+        return stats
+
+def _check_fork(fork):
+    # Peek at each generator's first Cage, then put it back:
+    firsts = [next(gen.gen) for gen in fork.gens]
+    for gen, c in zip(fork.gens, firsts):
+        gen.gen = itertools.chain([c], gen.gen)
+    fork.check(firsts)
@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
 
+import argparse
+import concurrent.futures
 import itertools
 
-import math
+import resource
+import sys
+import time
 import numpy
-import stl.mesh
 import trimesh
 
 import meshutil
 import meshgen
 import cage
+import prof
 
 # I should be moving some of these things out into more of a
 # standard library than an 'examples' script
@@ -25,9 +29,9 @@ def ram_horn():
     ], dtype=numpy.float64) - [0.5, 0.5, 0]
     xf0_to_1 = meshutil.Transform().translate(0,0,1)
     b1 = xf0_to_1.apply_to(b0)
-    meshes = []
-    meshes.append(meshutil.join_boundary_simple(b0, b1))
-    meshes.append(meshutil.close_boundary_simple(b0))
+    builder = meshutil.MeshBuilder()
+    builder.join(b0, b1)
+    builder.close(b0)
     for i in range(4):
         # Opening boundary:
         b = b1
@@ -36,18 +40,16 @@ def ram_horn():
             .scale(0.5) \
             .translate(0.25,0.25,1) \
             .rotate([0,0,1], i*numpy.pi/2)
-        for layer in range(128):
-            b_sub0 = xf.apply_to(b)
-            incr = meshutil.Transform() \
-                .scale(0.9) \
-                .rotate([-1,0,1], 0.3) \
-                .translate(0,0,0.8)
-            b_sub1 = incr.compose(xf).apply_to(b)
-            m = meshutil.join_boundary_simple(b_sub0, b_sub1)
-            meshes.append(m)
-            xf = incr.compose(xf)
+        incr = meshutil.Transform() \
+            .scale(0.9) \
+            .rotate([-1,0,1], 0.3) \
+            .translate(0,0,0.8)
+        # All 128 layers (plus the opening one) at once; each is 'incr'
+        # composed into the last, i.e. xf = incr.compose(xf):
+        bs = meshutil.sweep(xf, incr, 129, local=True).apply_to(b)
+        builder.join_stack(bs)
         # Close final boundary:
-        meshes.append(meshutil.close_boundary_simple(b_sub1[::-1,:]))
+        builder.close(bs[-1][::-1,:])
         # ::-1 is to reverse the boundary's order to fix winding order.
         # Not sure of the "right" way to fix winding order here.
         # The boundary vertices go in an identical order... it's just
@@ -58,19 +60,20 @@ def ram_horn():
 
     # I don't need to subdivide *geometry*.
     # I need to subdivide *space* and then put geometry in it.
-    mesh = meshutil.FaceVertexMesh.concat_many(meshes)
-    return mesh
+    return builder.to_mesh()
 
 # Rewriting the above in terms of generators & iterated transforms
-def ram_horn_gen(b, xf):
+# (computed 'chunk' layers at a time, since the generator is infinite)
+def ram_horn_gen(b, xf, chunk=64):
+    incr = meshutil.Transform() \
+        .scale(0.9) \
+        .rotate([-1,0,1], 0.3) \
+        .translate(0,0,0.8)
     while True:
-        b1 = xf.apply_to(b)
-        yield [b1]
-        incr = meshutil.Transform() \
-            .scale(0.9) \
-            .rotate([-1,0,1], 0.3) \
-            .translate(0,0,0.8)
-        xf = incr.compose(xf)
+        xfs = meshutil.sweep(xf, incr, chunk + 1, local=True)
+        for b1 in xfs[:-1].apply_to(b):
+            yield [b1]
+        xf = xfs[-1]
 
 def ram_horn2():
     b0 = numpy.array([
@@ -81,9 +84,9 @@ def ram_horn2():
     ], dtype=numpy.float64) - [0.5, 0.5, 0]
     xf0_to_1 = meshutil.Transform().translate(0,0,1)
     b1 = xf0_to_1.apply_to(b0)
-    meshes = []
-    meshes.append(meshutil.join_boundary_simple(b0, b1))
-    meshes.append(meshutil.close_boundary_simple(b0))
+    builder = meshutil.MeshBuilder()
+    builder.join(b0, b1)
+    builder.close(b0)
     for i in range(4):
         # Opening boundary:
         xf = meshutil.Transform() \
@@ -92,10 +95,8 @@ def ram_horn2():
             .translate(0.25,0.25,1) \
             .rotate([0,0,1], i*numpy.pi/2)
         gen = ram_horn_gen(b1, xf)
-        mesh = meshgen.gen2mesh(gen, count=128, close_last=True)
-        meshes.append(mesh)
-    mesh = meshutil.FaceVertexMesh.concat_many(meshes)
-    return mesh
+        meshgen.gen2mesh(gen, count=128, close_last=True, builder=builder)
+    return builder.to_mesh()
 
 # Rewriting the above rewrite in terms of Cage
 def ram_horn3():
@@ -133,7 +134,8 @@ def ram_horn3():
     mesh = cg.to_mesh(count=128, close_first=True, close_last=True)
     return mesh
 
-def ram_horn_branch():
+def ram_horn_branch(**kw):
+    # (Any 'kw' go to CageGen.to_mesh, e.g. shared=True or dry_run=True.)
     center = meshutil.Transform().translate(-0.5, -0.5, 0)
     cage0 = cage.Cage.from_arrays([
         [0, 0, 0],
@@ -169,7 +171,7 @@ def ram_horn_branch():
         recur(meshutil.Transform(), cage0, 8),
     ))
     # TODO: if this is just a list it seems silly to require itertools
-    mesh = cg.to_mesh(count=32, close_first=True, close_last=True)
+    mesh = cg.to_mesh(count=32, close_first=True, close_last=True, **kw)
     return mesh
 
 def dream_pendant():
@@ -206,8 +208,8 @@ def dream_pendant():
     ))
     # TODO: if this is just a list it seems silly to require itertools
     mesh1 = cg.to_mesh(count=32, close_first=False, close_last=True)
-    mesh2 = mesh1.transform(meshutil.Transform().rotate([0,1,0], math.pi))
-    return meshutil.FaceVertexMesh.concat_many([mesh1, mesh2])
+    # The other half is the same, turned around (copied only on export):
+    return meshutil.InstancedMesh.rotational(mesh1, [0,1,0], 2)
 
 def branch_test():
     b0 = numpy.array([
@@ -236,33 +238,33 @@ def twist(ang=0.1, dz=0.2, dx0=2, count=4, scale=0.98):
         [1, 1, 0],
         [0, 1, 0],
     ], dtype=numpy.float64) - [0.5, 0.5, 0]
-    meshes = []
-    for i in range(count):
-        xf = meshutil.Transform() \
-            .translate(dx0, 0, 0) \
-            .rotate([0,0,1], numpy.pi * 2 * i / count)
-        b0 = xf.apply_to(b)
-        meshes.append(meshutil.close_boundary_simple(b0))
-        for layer in range(256):
-            b_sub0 = xf.apply_to(b)
-            incr = meshutil.Transform() \
-                .rotate([0,0,1], ang) \
-                .translate(0,0,dz) \
-                .scale(scale)
-            b_sub1 = xf.compose(incr).apply_to(b)
-            m = meshutil.join_boundary_simple(b_sub0, b_sub1)
-            meshes.append(m)
-            xf = xf.compose(incr)
-        # Close final boundary:
-        meshes.append(meshutil.close_boundary_simple(b_sub1[::-1,:]))
-    mesh = meshutil.FaceVertexMesh.concat_many(meshes)
-    return mesh
+    builder = meshutil.MeshBuilder()
+    xf = meshutil.Transform().translate(dx0, 0, 0)
+    incr = meshutil.Transform() \
+        .rotate([0,0,1], ang) \
+        .translate(0,0,dz) \
+        .scale(scale)
+    # All 256 layers (plus the opening one) at once:
+    bs = meshutil.sweep(xf, incr, 257).apply_to(b)
+    builder.close(bs[0])
+    builder.join_stack(bs)
+    # Close final boundary:
+    builder.close(bs[-1][::-1,:])
+    # 'incr' commutes with rotating around Z, so every other twist is
+    # just this one rotated:
+    return meshutil.InstancedMesh.rotational(builder.to_mesh(), [0,0,1], count)
 
 def twist_nonlinear(dx0 = 2, dz=0.2, count=3, scale=0.99, layers=100):
     # This can be a function rather than a constant:
     angs = numpy.power(numpy.linspace(0.4, 2.0, layers), 2.0) / 10.0
     ang_fn = lambda i: angs[i]
     # (could it also be a function of space rather than which layer?)
+    incrs = meshutil.TransformArray.from_transforms(
+        meshutil.Transform()
+            .rotate([0,0,1], ang_fn(layer))
+            .translate(0,0,dz)
+            .scale(scale)
+        for layer in range(layers))
 
     b = numpy.array([
         [0, 0, 0],
@@ -270,28 +272,16 @@ def twist_nonlinear(dx0 = 2, dz=0.2, count=3, scale=0.99, layers=100):
         [1, 1, 0],
         [0, 1, 0],
     ], dtype=numpy.float64) - [0.5, 0.5, 0]
-    meshes = []
-    for i in range(count):
-        xf = meshutil.Transform() \
-            .translate(dx0, 0, 0) \
-            .rotate([0,0,1], numpy.pi * 2 * i / count)
-        b0 = xf.apply_to(b)
-        meshes.append(meshutil.close_boundary_simple(b0))
-        for layer in range(layers):
-            b_sub0 = xf.apply_to(b)
-            ang = ang_fn(layer)
-            incr = meshutil.Transform() \
-                .rotate([0,0,1], ang) \
-                .translate(0,0,dz) \
-                .scale(scale)
-            b_sub1 = xf.compose(incr).apply_to(b)
-            m = meshutil.join_boundary_simple(b_sub0, b_sub1)
-            meshes.append(m)
-            xf = xf.compose(incr)
-        # Close final boundary:
-        meshes.append(meshutil.close_boundary_simple(b_sub1[::-1,:]))
-    mesh = meshutil.FaceVertexMesh.concat_many(meshes)
-    return mesh
+    builder = meshutil.MeshBuilder()
+    xf = meshutil.Transform().translate(dx0, 0, 0)
+    # Every layer at once, despite a different increment per layer:
+    bs = meshutil.sweep(xf, incrs).apply_to(b)
+    builder.close(bs[0])
+    builder.join_stack(bs)
+    # Close final boundary:
+    builder.close(bs[-1][::-1,:])
+    # (As in twist, the others are this one rotated)
+    return meshutil.InstancedMesh.rotational(builder.to_mesh(), [0,0,1], count)
 
 def twist_from_gen():
     b = numpy.array([
@@ -306,9 +296,11 @@ def twist_from_gen():
     bs = [b]
     # since it needs a generator:
     gen_inner = itertools.repeat(bs)
-    gen = meshgen.gen_inc_y(meshgen.gen_twisted_boundary(gen_inner))
+    # gen_twisted_boundary's copies are each other rotated around Y, and
+    # gen_inc_y commutes with that, so build only one:
+    gen = meshgen.gen_inc_y(meshgen.gen_twisted_boundary(gen_inner, count=1))
     mesh = meshgen.gen2mesh(gen, 100, True)
-    return mesh
+    return meshutil.InstancedMesh.rotational(mesh, [0,1,0], 4)
 
 # frames = How many step to build this from:
 # turn = How many full turns to make in inner twist
@@ -346,10 +338,12 @@ def spiral_nested_2():
     # since it needs a generator:
     gen1 = itertools.repeat(bs)
     gen2 = meshgen.gen_twisted_boundary(gen1, ang=-0.2, dx0=0.5)
-    gen3 = meshgen.gen_twisted_boundary(gen2, ang=0.05, dx0=1)
+    # (Only one of the outermost copies; see twist_from_gen)
+    gen3 = meshgen.gen_twisted_boundary(gen2, count=1, ang=0.05, dx0=1)
     gen = meshgen.gen_inc_y(gen3, dy=0.1)
-    return meshgen.gen2mesh(
+    mesh = meshgen.gen2mesh(
         gen, count=250, flip_order=True, close_first=True, close_last=True)
+    return meshutil.InstancedMesh.rotational(mesh, [0,1,0], 4)
 
 def spiral_nested_3():
     # Slower.
@@ -367,35 +361,84 @@ def spiral_nested_3():
     gen1 = itertools.repeat(bs)
     gen2 = meshgen.gen_twisted_boundary(gen1, ang=-0.2, dx0=0.5)
     gen3 = meshgen.gen_twisted_boundary(gen2, ang=0.07, dx0=1)
-    gen4 = meshgen.gen_twisted_boundary(gen3, ang=-0.03, dx0=3)
+    # (Only one of the outermost copies; see twist_from_gen)
+    gen4 = meshgen.gen_twisted_boundary(gen3, count=1, ang=-0.03, dx0=3)
     gen = meshgen.gen_inc_y(gen4, dy=0.1)
-    return meshgen.gen2mesh(
+    mesh = meshgen.gen2mesh(
         gen, count=500, flip_order=True, close_first=True, close_last=True)
+    return meshutil.InstancedMesh.rotational(mesh, [0,1,0], 4)
+
+# Example name -> (function, output filename):
+outputs = {
+    "ram_horn": (ram_horn, "ramhorn.stl"),
+    "ram_horn2": (ram_horn2, "ramhorn2.stl"),
+    # TODO: Fix
+    #"ram_horn3": (ram_horn3, "ramhorn3.stl"),
+    "ram_horn_branch": (ram_horn_branch, "ramhorn_branch.stl"),
+    "dream_pendant": (dream_pendant, "dream_pendant.stl"),
+    "twist": (twist, "twist.stl"),
+    "twist_nonlinear": (twist_nonlinear, "twist_nonlinear.stl"),
+    "twist_from_gen": (twist_from_gen, "twist_from_gen.stl"),
+    "twisty_torus": (twisty_torus, "twisty_torus.stl"),
+    "spiral_nested_2": (spiral_nested_2, "spiral_nested_2.stl"),
+    "spiral_nested_3": (spiral_nested_3, "spiral_nested_3.stl"),
+}
+
+def run_example(name):
+    # Generate one example and save its STL.  This runs in a worker
+    # process, so only these small stats (not the mesh) come back.
+    f, fname = outputs[name]
+    t0 = time.perf_counter()
+    mesh = f()
+    nv = mesh.nv
+    nf = mesh.nf
+    mesh.save_stl(fname)
+    dt = time.perf_counter() - t0
+    # (ru_maxrss is in KiB on Linux)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if prof.enabled:
+        # With MESHGEN_PROFILE set, report per example, and then forget
+        # it, so that nothing reports it again (e.g. a spawned worker's
+        # atexit handler):
+        sys.stderr.write("Profile of {}:\n".format(name))
+        prof.report(sys.stderr)
+        prof.reset()
+    return name, fname, dt, nv, nf, rss
 
-def main():
-    fns = {
-        ram_horn: "ramhorn.stl",
-        ram_horn2: "ramhorn2.stl",
-        # TODO: Fix
-        #ram_horn3: "ramhorn3.stl",
-        ram_horn_branch: "ramhorn_branch.stl",
-        dream_pendant: "dream_pendant.stl",
-        twist: "twist.stl",
-        twist_nonlinear: "twist_nonlinear.stl",
-        twist_from_gen: "twist_from_gen.stl",
-        twisty_torus: "twisty_torus.stl",
-        spiral_nested_2: "spiral_nested_2.stl",
-        spiral_nested_3: "spiral_nested_3.stl",
-    }
-    for f in fns:
-        fname = fns[f]
-        print("Generate {}...".format(fname))
-        mesh = f()
-        nv = mesh.v.shape[0]
-        nf = mesh.f.shape[0]
-        print("Saving {} verts & {} faces...".format(nv, nf))
-        mesh.to_stl_mesh().save(fname)
-        print("Done.")
+def main(names=None, workers=None):
+    # Generate the examples in 'names' (default: all of them) with up to
+    # 'workers' processes (default: one per CPU), then print a summary.
+    if names is None:
+        names = list(outputs)
+    for name in names:
+        if name not in outputs:
+            raise ValueError("Unknown example {}; choose from: {}".format(
+                name, ", ".join(outputs)))
+    results = {}
+    # One process per example, so that peak RSS is per-example:
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, max_tasks_per_child=1) as pool:
+        futures = [pool.submit(run_example, name) for name in names]
+        for name in names:
+            print("Generate {}...".format(outputs[name][1]))
+        for fut in concurrent.futures.as_completed(futures):
+            name, fname, dt, nv, nf, rss = fut.result()
+            print("Done with {} ({:.2f} s).".format(fname, dt))
+            results[name] = (fname, dt, nv, nf, rss)
+    print()
+    print("{:<24} {:>9} {:>10} {:>10} {:>10}".format(
+        "file", "time (s)", "verts", "faces", "RSS (MiB)"))
+    for name in names:
+        fname, dt, nv, nf, rss = results[name]
+        print("{:<24} {:>9.2f} {:>10} {:>10} {:>10.1f}".format(
+            fname, dt, nv, nf, rss))
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Generate example meshes as STL")
+    parser.add_argument("names", nargs="*",
+                        help="Examples to generate (default: all): " +
+                        ", ".join(outputs))
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="Number of worker processes (default: CPU count)")
+    args = parser.parse_args()
+    main(args.names or None, args.workers)
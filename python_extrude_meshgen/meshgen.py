@@ -1,7 +1,7 @@
 import itertools
 
 import meshutil
-import stl.mesh
+import prof
 import numpy
 import trimesh
 
@@ -20,19 +20,17 @@ def gen_twisted_boundary(gen=None, count=4, dx0=2, ang=0.1):
         ], dtype=numpy.float64) - [0.5, 0, 0.5]
         gen = itertools.repeat([b])
     # Generate 'seed' transformations:
-    xfs = [meshutil.Transform().translate(dx0, 0, 0).rotate([0,1,0], numpy.pi * 2 * i / count)
-           for i in range(count)]
+    xfs = meshutil.TransformArray.from_transforms(
+        meshutil.Transform().translate(dx0, 0, 0).rotate([0,1,0], numpy.pi * 2 * i / count)
+        for i in range(count))
     # (we'll increment the transforms in xfs as we go)
     for bs in gen:
-        xfs_new = []
-        bs2 = []
-        for i, xf in enumerate(xfs):
-            # Generate a boundary from running transform:
-            bs2 += [xf.apply_to(b) for b in bs]
-            # Increment transform i:
-            xf2 = xf.rotate([0,1,0], ang)
-            xfs_new.append(xf2)
-        xfs = xfs_new
+        # Generate boundaries from every running transform at once;
+        # bs_xf[j][i] is boundary j under transform i:
+        bs_xf = [xfs.apply_to(b) for b in bs]
+        bs2 = [b_xf[i] for i in range(count) for b_xf in bs_xf]
+        # Increment all transforms:
+        xfs = xfs.rotate([0,1,0], ang)
         yield bs2
 
 # This is to see how well it works to compose generators:
@@ -63,37 +61,153 @@ def gen_torus_xy(gen, rad=2, frames=100):
 
 # String together boundaries from a generator.
 # If count is nonzero, run only this many iterations.
+# If 'builder' (a meshutil.MeshBuilder) is given, geometry is added to it.
+# If 'shared' is True, each boundary's vertices are added only once and
+# shared by everything that touches them (which needs the default
+# join_fn); otherwise every join and cap gets its own copies.
+# If 'dry_run' is True, nothing is built; this returns a
+# meshutil.MeshStats with the counts and bounds the mesh would have
+# (and adds them to 'builder' if that is a MeshStats).
+# (For prof, elements are boundary vertices taken from 'gen'.)
+@prof.counted("gen2mesh")
 def gen2mesh(gen, count=0, flip_order=False, loop=False,
              close_first = False,
              close_last = False,
-             join_fn=meshutil.join_boundary_simple):
+             join_fn=meshutil.join_boundary_simple,
+             builder=None,
+             shared=False,
+             dry_run=False):
+    if shared and join_fn is not meshutil.join_boundary_simple:
+        raise ValueError("shared=True works only with join_boundary_simple")
+    if dry_run:
+        return _gen2mesh_stats(gen, count, loop, close_first, close_last,
+                               join_fn, builder, shared)
+    if builder is None:
+        builder = meshutil.MeshBuilder()
     # Get first list of boundaries:
     bs_first = next(gen)
-    bs_last = bs_first
+    # Gather every list of boundaries first, so that each boundary's
+    # whole sweep can be joined at once:
+    layers = [bs_first]
+    for i,bs_cur in enumerate(gen):
+        if count > 0 and i >= count:
+            break
+        layers.append(bs_cur)
+    prof.add_elements("gen2mesh", len(layers) * sum([b.shape[0] for b in bs_first]))
+    bs_last = layers[-1]
+    if shared:
+        idxs = [builder.add_stack(numpy.stack([bs[j] for bs in layers]))
+                for j,_ in enumerate(bs_first)]
+        if close_first:
+            for idx in idxs:
+                builder.close_idx(idx[0])
+        builder.join_idx(idxs, flip_order=flip_order, loop=loop)
+        if close_last:
+            for idx in idxs:
+                builder.close_idx(idx[-1])
+        return builder.to_mesh()
     # TODO: Begin and end with close_boundary_simple
-    meshes = []
     if close_first:
         for b in bs_first:
-            meshes.append(meshutil.close_boundary_simple(b))
+            builder.close(b)
+    if join_fn is meshutil.join_boundary_simple:
+        stacks = [numpy.stack([bs[j] for bs in layers])
+                  for j,_ in enumerate(bs_first)]
+        builder.join_stack(stacks, flip_order=flip_order, loop=loop)
+    else:
+        for bs_prev,bs_cur in zip(layers, layers[1:]):
+            for j,b in enumerate(bs_cur):
+                if flip_order:
+                    m = join_fn(b, bs_prev[j])
+                else:
+                    m = join_fn(bs_prev[j], b)
+                builder.add(m)
+        if loop:
+            for b0,b1 in zip(bs_last, bs_first):
+                if flip_order:
+                    m = join_fn(b1, b0)
+                else:
+                    m = join_fn(b0, b1)
+                builder.add(m)
+    if close_last:
+        for b in bs_last:
+            builder.close(b)
+    return builder.to_mesh()
+
+def _gen2mesh_stats(gen, count, loop, close_first, close_last, join_fn,
+                    stats, shared):
+    # gen2mesh(..., dry_run=True): only boundary sizes & bounds are
+    # looked at, one list of boundaries at a time.
+    if join_fn is not meshutil.join_boundary_simple:
+        raise ValueError("dry_run=True works only with join_boundary_simple")
+    if stats is None:
+        stats = meshutil.MeshStats()
+    bs_first = next(gen)
+    layers = 1
+    for b in bs_first:
+        stats.see(b)
     for i,bs_cur in enumerate(gen):
         if count > 0 and i >= count:
             break
-        for j,b in enumerate(bs_cur):
-            if flip_order:
-                m = join_fn(b, bs_last[j])
-            else:
-                m = join_fn(bs_last[j], b)
-            meshes.append(m)
-        bs_last = bs_cur
-    if loop:
-        for b0,b1 in zip(bs_last, bs_first):
-            if flip_order:
-                m = join_fn(b1, b0)
+        layers += 1
+        for b in bs_cur:
+            stats.see(b)
+    prof.add_elements("gen2mesh", layers * sum([b.shape[0] for b in bs_first]))
+    for b in bs_first:
+        n = b.shape[0]
+        if shared:
+            stats.add_stack(n, layers)
+        if close_first:
+            stats.close(n, shared)
+        stats.join_stack(n, layers, loop=loop, shared=shared)
+        if close_last:
+            stats.close(n, shared)
+    return stats
+
+# Like gen2mesh, but rather than returning a mesh, this writes it to a
+# binary STL file 'fname' one pair of boundary lists at a time.  Only
+# the first and the most recent list of boundaries are kept, so memory
+# use doesn't depend on how many the generator produces.
+# Returns the number of triangles written.
+# (For prof, elements are boundary vertices taken from 'gen'.)
+@prof.counted("gen2stl")
+def gen2stl(gen, fname, count=0, flip_order=False, loop=False,
+            close_first = False,
+            close_last = False,
+            join_fn=meshutil.join_boundary_simple):
+    # Reused for every pair so its buffers are only allocated once:
+    builder = meshutil.MeshBuilder()
+    with meshutil.StlWriter(fname) as writer:
+        def join(bs0, bs1):
+            builder.clear()
+            if join_fn is meshutil.join_boundary_simple:
+                stacks = [numpy.stack([b0, b1]) for b0,b1 in zip(bs0, bs1)]
+                builder.join_stack(stacks, flip_order=flip_order)
             else:
-                m = join_fn(b0, b1)
-            meshes.append(m)
-    if close_last:
-        for b in bs_last:
-            meshes.append(meshutil.close_boundary_simple(b))
-    mesh = meshutil.FaceVertexMesh.concat_many(meshes)
-    return mesh
+                for b0,b1 in zip(bs0, bs1):
+                    if flip_order:
+                        builder.add(join_fn(b1, b0))
+                    else:
+                        builder.add(join_fn(b0, b1))
+            writer.write(builder.to_mesh())
+        def close(bs):
+            builder.clear()
+            for b in bs:
+                builder.close(b)
+            writer.write(builder.to_mesh())
+        bs_first = next(gen)
+        prof.add_elements("gen2stl", sum([b.shape[0] for b in bs_first]))
+        bs_last = bs_first
+        if close_first:
+            close(bs_first)
+        for i,bs_cur in enumerate(gen):
+            if count > 0 and i >= count:
+                break
+            prof.add_elements("gen2stl", sum([b.shape[0] for b in bs_cur]))
+            join(bs_last, bs_cur)
+            bs_last = bs_cur
+        if loop:
+            join(bs_last, bs_first)
+        if close_last:
+            close(bs_last)
+        return writer.count
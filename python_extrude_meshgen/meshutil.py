@@ -1,8 +1,10 @@
-import stl.mesh
+import functools
+import struct
+
 import numpy
 import quaternion
-import random
 
+import prof
 import quat
 
 # (left/right, bottom/top, back/front)
@@ -17,6 +19,15 @@ rbb = numpy.array([1,0,1])
 ltb = numpy.array([0,1,1])
 rtb = numpy.array([1,1,1])
 
+# One record of a binary STL file (50 bytes, little-endian, unpadded):
+# facet normal, three vertices, and a 2-byte attribute count.  This is
+# the same layout as stl.mesh.Mesh.dtype.
+stl_dtype = numpy.dtype([
+    ("normals", "<f4", (3,)),
+    ("vectors", "<f4", (3,3)),
+    ("attr", "<u2", (1,)),
+])
+
 class FaceVertexMesh(object):
     def __init__(self, v, f):
         # v & f should both be of shape (N,3)
@@ -28,19 +39,57 @@ class FaceVertexMesh(object):
         f2 = numpy.concatenate([self.f, other_mesh.f + self.v.shape[0]])
         m2 = FaceVertexMesh(v2, f2)
         return m2
+    @property
+    def nv(self):
+        return self.v.shape[0]
+    @property
+    def nf(self):
+        return self.f.shape[0]
+    def bounds(self):
+        # (lo, hi): opposite corners of the axis-aligned bounding box.
+        return self.v.min(axis=0), self.v.max(axis=0)
     def transform(self, xform):
         # Just transform vertices. Indices don't change.
         return FaceVertexMesh(xform.apply_to(self.v), self.f)
+    @prof.counted("FaceVertexMesh.weld", lambda self, *a, **kw: self.v.shape[0])
+    def weld(self, tol=1e-6):
+        # Merge vertices that are within 'tol' of each other (see
+        # weld_vertices), remap faces accordingly, and drop any faces that
+        # become degenerate.  Returns a new FaceVertexMesh.
+        remap, keep = weld_vertices(self.v, tol)
+        f = remap[self.f]
+        ok = (f[:,0] != f[:,1]) & (f[:,1] != f[:,2]) & (f[:,2] != f[:,0])
+        return FaceVertexMesh(self.v[keep], f[ok])
+    def triangles(self):
+        # Vertices of every face, shape (M,3,3):
+        return self.v[self.f]
+    def facet_normals(self):
+        # Unit normal of every face (by winding order), shape (M,3).
+        # Degenerate faces get a zero normal.
+        return _facet_normals(self.triangles())
+    @prof.counted("FaceVertexMesh.to_stl_records", lambda self: self.f.shape[0])
+    def to_stl_records(self):
+        # Returns binary STL records (see stl_dtype) for every face.
+        return _stl_records(self.triangles())
     def to_stl_mesh(self):
-        data = numpy.zeros(self.f.shape[0], dtype=stl.mesh.Mesh.dtype)
-        v = data["vectors"]
-        for i, (iv0, iv1, iv2) in enumerate(self.f):
-            v[i] = [self.v[iv0], self.v[iv1], self.v[iv2]]
-        return stl.mesh.Mesh(data)
+        # Only this needs numpy-stl; save_stl writes STL without it.
+        import stl.mesh
+        data = self.to_stl_records()
+        return stl.mesh.Mesh(data, calculate_normals=False)
+    def save_stl(self, fname, header=b"meshutil"):
+        # Write as a binary STL file.
+        write_stl(fname, self.to_stl_records(), header)
+    def save_bundle(self, fname, **attrs):
+        # Write as a mesh bundle (see blender_scraps/meshbundle.py), e.g.
+        # for Blender.  'attrs' may give edges=... and per-element arrays
+        # like vertex_NAME=... or face_NAME=...
+        meshbundle = _import_meshbundle()
+        meshbundle.write_mesh(fname, self.v, self.f, **attrs)
     @classmethod
     def Empty(cls):
         return FaceVertexMesh(numpy.zeros((0,3)), numpy.zeros((0,3), dtype=int))
     @classmethod
+    @prof.counted("FaceVertexMesh.concat_many", lambda cls, meshes: len(meshes))
     def concat_many(cls, meshes):
         nv = 0
         nf = 0
@@ -60,12 +109,536 @@ class FaceVertexMesh(object):
             fi = fj
         return FaceVertexMesh(v, f)
 
+class InstancedMesh(object):
+    """One FaceVertexMesh, 'base', repeated under each of K transforms.
+
+    Only 'base' and the K transforms (a TransformArray, or an array of
+    shape (K,4,4)) are kept.  Copies are only made when something needs
+    the actual geometry: to_mesh() and weld() make all of them at once,
+    while iter_meshes(), save_stl() and bounds() go a chunk of copies at
+    a time, so they need memory only for 'chunk' copies.  Counts (nv,
+    nf) come from 'base' alone.
+
+    A transform that mirrors (negative determinant) would turn its copy
+    inside-out, so that copy's faces have their winding order reversed.
+    """
+    def __init__(self, base, xforms):
+        if not isinstance(xforms, TransformArray):
+            xforms = TransformArray(numpy.asarray(xforms))
+        self.base = base
+        self.xforms = xforms
+    @classmethod
+    def rotational(cls, base, axis, count):
+        """'count' copies of 'base', evenly spaced around 'axis' (through
+        the origin), starting with 'base' itself."""
+        return cls(base, TransformArray.from_transforms(
+            Transform().rotate(axis, 2 * numpy.pi * i / count)
+            for i in range(count)))
+    def __len__(self):
+        return len(self.xforms)
+    @property
+    def nv(self):
+        return len(self) * self.base.nv
+    @property
+    def nf(self):
+        return len(self) * self.base.nf
+    def transform(self, xform):
+        # Just the instance transforms change; 'base' is shared.
+        return InstancedMesh(self.base, self.xforms.compose(xform))
+    @prof.counted("InstancedMesh._expand", lambda self, k0, k1: (k1 - k0) * self.base.nv)
+    def _expand(self, k0, k1):
+        # One FaceVertexMesh of copies k0...k1-1.
+        xfs = self.xforms[k0:k1]
+        v = xfs.apply_to(self.base.v)
+        nv = self.base.nv
+        flip = numpy.linalg.det(xfs.mtx[:,:3,:3]) < 0
+        f = numpy.where(flip[:,numpy.newaxis,numpy.newaxis],
+                        self.base.f[numpy.newaxis,:,::-1],
+                        self.base.f[numpy.newaxis])
+        f = f + nv * numpy.arange(k1 - k0)[:,numpy.newaxis,numpy.newaxis]
+        return FaceVertexMesh(v.reshape(-1, 3), f.reshape(-1, 3))
+    def iter_meshes(self, chunk=16):
+        """Yield a FaceVertexMesh of every 'chunk' copies in turn."""
+        for k0 in range(0, len(self), chunk):
+            yield self._expand(k0, min(k0 + chunk, len(self)))
+    def to_mesh(self):
+        """Every copy, as one FaceVertexMesh."""
+        if len(self) == 0:
+            return FaceVertexMesh.Empty()
+        return self._expand(0, len(self))
+    def weld(self, tol=1e-6):
+        # (Copies may well touch each other, so this must see them all)
+        return self.to_mesh().weld(tol)
+    def bounds(self, chunk=16):
+        # As FaceVertexMesh.bounds, over every copy.
+        lo = numpy.full(3, numpy.inf)
+        hi = numpy.full(3, -numpy.inf)
+        for k0 in range(0, len(self), chunk):
+            v = self.xforms[k0:k0 + chunk].apply_to(self.base.v)
+            lo = numpy.minimum(lo, v.min(axis=(0, 1), initial=numpy.inf))
+            hi = numpy.maximum(hi, v.max(axis=(0, 1), initial=-numpy.inf))
+        return lo, hi
+    def to_stl_records(self):
+        return numpy.concatenate(
+            [m.to_stl_records() for m in self.iter_meshes()] +
+            [numpy.zeros(0, dtype=stl_dtype)])
+    def save_stl(self, fname, header=b"meshutil", chunk=16):
+        # Write as a binary STL file, 'chunk' copies at a time.
+        with StlWriter(fname, header) as writer:
+            for m in self.iter_meshes(chunk):
+                writer.write(m)
+    def save_bundle(self, fname, **attrs):
+        # As FaceVertexMesh.save_bundle (a bundle needs every copy at once).
+        self.to_mesh().save_bundle(fname, **attrs)
+
+def _import_meshbundle():
+    # meshbundle lives with the Blender code that reads it, in
+    # ../blender_scraps, which isn't otherwise on the path:
+    try:
+        import meshbundle
+    except ImportError:
+        import os, sys
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     os.pardir, "blender_scraps"))
+        import meshbundle
+    return meshbundle
+
+# Offsets (in units of tol) of the 8 grids near_pairs uses:
+_grid_shifts = numpy.array([
+    (sx, sy, sz) for sx in (0, 1) for sy in (0, 1) for sz in (0, 1)
+])
+
+def cell_key(c):
+    # 64-bit hash of each row of 'c' (shape (...,3), integers or 64-bit
+    # patterns, e.g. grid cell coordinates; overflow simply wraps):
+    c = c.astype(numpy.uint64)
+    return (c[..., 0] * numpy.uint64(0x9E3779B97F4A7C15)) ^ \
+           (c[..., 1] * numpy.uint64(0xC2B2AE3D27D4EB4F)) ^ \
+           (c[..., 2] * numpy.uint64(0x165667B19E3779F9))
+
+def expand_ranges(lo, hi):
+    # For ranges [lo[i], hi[i]), returns (i, k) for every k in each
+    # range, as two flat arrays.
+    counts = hi - lo
+    i = numpy.repeat(numpy.arange(lo.shape[0]), counts)
+    start = numpy.repeat(lo - (numpy.cumsum(counts) - counts), counts)
+    return i, start + numpy.arange(i.shape[0])
+
+def near_pairs(p, tol):
+    # Returns (a, b): every pair of rows of 'p' (shape (N,3)) within
+    # 'tol' of each other, each once (with a < b).
+    #
+    # This uses 8 grids of cells 2*tol on a side, each shifted by 0 or
+    # tol along each axis.  Along one axis, two points within tol are
+    # split by a cell boundary of at most one of the two shifts (the
+    # boundaries alternate every tol), so in 3D they share a cell in at
+    # least one of the 8 grids - and it's enough to compare points in
+    # the same cell, found by sorting cell keys.  That's 8 sorts, and no
+    # lookups of neighbouring cells, so about O(N log N) with a small
+    # log, unless very many points crowd into a few cells.
+    if not tol > 0:
+        raise ValueError("tol must be positive, not {}".format(tol))
+    base = numpy.floor(p / tol).astype(numpy.int64)
+    # Each axis's part of cell_key, for either shift; a grid's keys are
+    # then three of these XORed together:
+    parts = [[cell_key(numpy.where(numpy.arange(3) == axis,
+                                   (base[:, axis, numpy.newaxis] + s) >> 1, 0))
+              for s in (0, 1)]
+             for axis in range(3)]
+    # run[g][k] is which cell (run of equal keys) of grid g point k is in
+    # - so two points have been compared already if they shared a run in
+    # an earlier grid.
+    run = []
+    a = []
+    b = []
+    for g, (sx, sy, sz) in enumerate(_grid_shifts):
+        keys = parts[0][sx] ^ parts[1][sy] ^ parts[2][sz]
+        order = numpy.argsort(keys)
+        sk = keys[order]
+        # Runs of equal keys, as ranges [start, stop) of 'order':
+        edge = numpy.flatnonzero(sk[1:] != sk[:-1]) + 1
+        start = numpy.concatenate([[0], edge])
+        stop = numpy.concatenate([edge, [sk.shape[0]]])
+        run.append(numpy.empty(p.shape[0], dtype=numpy.int64))
+        run[g][order] = numpy.repeat(numpy.arange(start.shape[0]), stop - start)
+        multi = stop - start > 1
+        start = start[multi]
+        stop = stop[multi]
+        if g > 0 and start.size:
+            # Cells whose points all shared one grid-0 cell too were
+            # done there already:
+            r0 = run[0][order]
+            bounds = numpy.stack([start, stop - 1], axis=1).ravel()
+            new = ((numpy.minimum.reduceat(r0, bounds)[::2] !=
+                    numpy.maximum.reduceat(r0, bounds)[::2]) |
+                   (r0[start] != r0[stop - 1]))
+            start = start[new]
+            stop = stop[new]
+        # Every point of a cell against every later point in it.  (A
+        # hash collision just adds pairs the distance check removes.)
+        m, i = expand_ranges(start, stop - 1)
+        _, j = expand_ranges(i + 1, stop[m])
+        i = order[numpy.repeat(i, stop[m] - i - 1)]
+        j = order[j]
+        # Keep each pair only in the first grid that compares it:
+        for r in run[:g]:
+            new = r[i] != r[j]
+            i = i[new]
+            j = j[new]
+        d = p[i] - p[j]
+        near = numpy.einsum("ij,ij->i", d, d) <= tol*tol
+        a.append(numpy.minimum(i[near], j[near]))
+        b.append(numpy.maximum(i[near], j[near]))
+    return numpy.concatenate(a), numpy.concatenate(b)
+
+def weld_vertices(v, tol):
+    # Finds which vertices in 'v' (shape (N,3)) to merge: any two within
+    # 'tol' of each other are, and so (transitively) are chains of them,
+    # as usual for welding.  Exact duplicates are merged first, so that
+    # many copies of one vertex (e.g. at a pole) cost nothing more; the
+    # rest is near_pairs.
+    #
+    # Returns (remap, keep): 'keep' gives the indices of vertices to keep
+    # (shape (M,); the first of every merged group, in their original
+    # order), and remap[i] gives the new index (into v[keep]) of vertex i.
+    # 'tol' must be positive.
+    if not tol > 0:
+        raise ValueError("tol must be positive, not {}".format(tol))
+    # (+ 0.0 makes any -0.0 into 0.0, so their bits match too.)
+    v = numpy.ascontiguousarray(v, dtype=numpy.float64) + 0.0
+    n = v.shape[0]
+    _, first, inverse = numpy.unique(
+        cell_key(v.view(numpy.uint64)), return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    if not numpy.array_equal(v, v[first[inverse]]):
+        # Hash collision (very unlikely): fall back to comparing rows,
+        # which is exact but slower.
+        _, first, inverse = numpy.unique(
+            v, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+    a, b = near_pairs(v[first], tol)
+    # Connected components of distinct points: hook each pair's roots
+    # together (to the lower label), and then compress paths, until
+    # stable.
+    labels = numpy.arange(first.shape[0])
+    while True:
+        la = labels[a]
+        lb = labels[b]
+        if numpy.array_equal(la, lb):
+            break
+        lo = numpy.minimum(la, lb)
+        numpy.minimum.at(labels, la, lo)
+        numpy.minimum.at(labels, lb, lo)
+        while True:
+            jumped = labels[labels]
+            if numpy.array_equal(jumped, labels):
+                break
+            labels = jumped
+    # Each component keeps its lowest-numbered vertex:
+    rep = numpy.full(first.shape[0], n)
+    numpy.minimum.at(rep, labels, first)
+    rep = rep[labels]
+    keep = numpy.unique(rep)
+    rank = numpy.zeros(n, dtype=numpy.int64)
+    rank[keep] = numpy.arange(keep.shape[0])
+    return rank[rep][inverse], keep
+
+def _facet_normals(tris):
+    # tris has shape (M,3,3); returns unit normals of shape (M,3).
+    n = numpy.cross(tris[:,1,:] - tris[:,0,:], tris[:,2,:] - tris[:,0,:])
+    norm = numpy.linalg.norm(n, axis=1, keepdims=True)
+    return numpy.divide(n, norm, out=numpy.zeros_like(n), where=norm > 0)
+
+def _stl_records(tris):
+    # tris has shape (M,3,3); returns STL records of shape (M,).
+    data = numpy.zeros(tris.shape[0], dtype=stl_dtype)
+    data["vectors"] = tris
+    data["normals"] = _facet_normals(tris)
+    return data
+
+def _stl_header(header, count):
+    # 80-byte header, then little-endian uint32 triangle count:
+    return header[:80].ljust(80, b"\0") + struct.pack("<I", count)
+
+@prof.counted("write_stl", lambda fname, records, *a, **kw: records.shape[0])
+def write_stl(fname, records, header=b"meshutil"):
+    """Write STL records (array of stl_dtype) to a binary STL file."""
+    with open(fname, "wb") as fd:
+        fd.write(_stl_header(header, records.shape[0]))
+        records.tofile(fd)
+
+class StlWriter(object):
+    """Writes triangles to a binary STL file incrementally.
+
+    The triangle count in the header is written as zero at first and
+    filled in by close(), so nothing needs to be kept in memory besides
+    whatever is being written at the moment.  This can be used as a
+    context manager.
+    """
+    def __init__(self, fname, header=b"meshutil"):
+        self.fd = open(fname, "wb")
+        self.header = header
+        self.count = 0
+        self.fd.write(_stl_header(header, 0))
+    def write(self, mesh):
+        """Append every face of a FaceVertexMesh."""
+        self.write_records(mesh.to_stl_records())
+    def write_records(self, records):
+        """Append STL records (array of stl_dtype)."""
+        records.tofile(self.fd)
+        self.count += records.shape[0]
+    def close(self):
+        """Patch the triangle count into the header and close the file."""
+        if self.fd.closed:
+            return
+        self.fd.seek(0)
+        self.fd.write(_stl_header(self.header, self.count))
+        self.fd.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+def _stack_elements(self, stacks, *a, **kw):
+    # For profiling: total vertices in a stack (or list of stacks) of
+    # boundaries or of boundary indices.
+    if isinstance(stacks, numpy.ndarray):
+        return stacks.size // (3 if stacks.ndim == 3 else 1)
+    return sum(s.size // (3 if s.ndim == 3 else 1) for s in stacks)
+
+class MeshBuilder(object):
+    """Accumulates vertices & faces for a FaceVertexMesh in place.
+
+    Vertices and faces go into preallocated buffers which double in size
+    when they run out of room, so building a mesh from thousands of
+    small pieces doesn't need a list of FaceVertexMesh and a final
+    concat_many.  The join/close methods write their output directly
+    into these buffers.
+    """
+    def __init__(self, nv=1024, nf=1024):
+        self._v = numpy.zeros((nv,3), dtype=numpy.float64)
+        self._f = numpy.zeros((nf,3), dtype=int)
+        # Number of rows of _v and _f that are actually in use:
+        self.nv = 0
+        self.nf = 0
+    def reserve(self, nv, nf):
+        """Ensure room for 'nv' more vertices and 'nf' more faces."""
+        if self.nv + nv > self._v.shape[0]:
+            size = max(self.nv + nv, 2*self._v.shape[0])
+            v = numpy.zeros((size,3), dtype=self._v.dtype)
+            v[:self.nv] = self._v[:self.nv]
+            self._v = v
+        if self.nf + nf > self._f.shape[0]:
+            size = max(self.nf + nf, 2*self._f.shape[0])
+            f = numpy.zeros((size,3), dtype=self._f.dtype)
+            f[:self.nf] = self._f[:self.nf]
+            self._f = f
+    def _alloc(self, nv, nf):
+        # Claim 'nv' vertex rows and 'nf' face rows; returns writable views
+        # of both.
+        self.reserve(nv, nf)
+        v = self._v[self.nv:self.nv + nv]
+        f = self._f[self.nf:self.nf + nf]
+        self.nv += nv
+        self.nf += nf
+        return v, f
+    def add_verts(self, vs):
+        """Append vertices (shape (N,3)); returns index of the first."""
+        vi = self.nv
+        v, _ = self._alloc(vs.shape[0], 0)
+        v[:] = vs
+        return vi
+    def add_faces(self, fs, offset=0):
+        """Append faces (shape (M,3)), with 'offset' added to indices."""
+        _, f = self._alloc(0, fs.shape[0])
+        numpy.add(fs, offset, out=f)
+    def add(self, mesh):
+        """Append a FaceVertexMesh; returns index of its first vertex."""
+        vi = self.nv
+        v, f = self._alloc(mesh.v.shape[0], mesh.f.shape[0])
+        v[:] = mesh.v
+        numpy.add(mesh.f, vi, out=f)
+        return vi
+    def join(self, bound1, bound2, random_diag=False, rng=None):
+        """Append join_boundary_simple(bound1, bound2, ...)."""
+        self.join_stack(numpy.stack([bound1, bound2]),
+                        random_diag=random_diag, rng=rng)
+    @prof.counted("MeshBuilder.join_stack", _stack_elements)
+    def join_stack(self, stacks, flip_order=False, loop=False,
+                   random_diag=False, rng=None, closed=True):
+        """Append join_boundary_stack(stacks, ...)."""
+        if isinstance(stacks, numpy.ndarray):
+            stacks = [stacks]
+        if random_diag:
+            rng = numpy.random.default_rng(rng)
+        # Make room for everything up front:
+        nv = 0
+        nf = 0
+        for stack in stacks:
+            layers, n, _ = stack.shape
+            p = layers - 1 + (1 if loop else 0)
+            nv += 2*n*p
+            nf += 2*(n if closed else n - 1)*p
+        self.reserve(nv, nf)
+        for stack in stacks:
+            layers, n, _ = stack.shape
+            b0 = stack[:-1]
+            b1 = stack[1:]
+            if loop:
+                b0 = numpy.concatenate([b0, stack[-1:]])
+                b1 = numpy.concatenate([b1, stack[:1]])
+            if flip_order:
+                b0, b1 = b1, b0
+            p = b0.shape[0]
+            q = n if closed else n - 1
+            vi = self.nv
+            v, f = self._alloc(2*n*p, 2*q*p)
+            # Vertices for pair k are rows 2*N*k...2*N*(k+1)-1:
+            v = v.reshape(p, 2*n, 3)
+            v[:, :n] = b0
+            v[:, n:] = b1
+            pair_idx = numpy.arange(vi, vi + 2*n*p).reshape(p, 2*n)
+            _strip_faces(pair_idx, n, random_diag=random_diag, rng=rng,
+                         closed=closed, out=f)
+    @prof.counted("MeshBuilder.close", lambda self, bound, *a, **kw: bound.shape[0])
+    def close(self, bound, reverse=False):
+        """Append close_boundary_simple(bound, reverse)."""
+        n = bound.shape[0]
+        vi = self.nv
+        tmpl = _fan_template(n, reverse)
+        v, f = self._alloc(n + 1, tmpl.shape[0])
+        v[:n] = bound
+        v[n] = numpy.mean(bound, axis=0)
+        numpy.add(tmpl, vi, out=f)
+    # The methods below are for building meshes in which vertices are
+    # shared rather than copied for every join and cap.  They refer to
+    # vertices already added (e.g. with add_verts or add_stack) by index.
+    def add_stack(self, stack):
+        """Append a stack of boundaries (shape (L,N,3)) as vertices, once
+        each; returns their indices as an array of shape (L,N)."""
+        layers, n, _ = stack.shape
+        vi = self.add_verts(stack.reshape(-1, 3))
+        return numpy.arange(vi, vi + layers*n).reshape(layers, n)
+    @prof.counted("MeshBuilder.join_idx", _stack_elements)
+    def join_idx(self, idx, flip_order=False, loop=False, random_diag=False,
+                 rng=None, closed=True):
+        """Like join_stack, but for boundaries given as vertex indices.
+
+        'idx' has shape (L,N) - row k giving the indices of boundary k -
+        or is a list of such arrays.  Only faces are added, so joined
+        boundaries share their vertices (including at the seam if 'loop'
+        is True).
+        """
+        if isinstance(idx, numpy.ndarray):
+            idx = [idx]
+        if random_diag:
+            rng = numpy.random.default_rng(rng)
+        for rows in idx:
+            pair_idx = numpy.concatenate([rows[:-1], rows[1:]], axis=1)
+            if loop:
+                seam = numpy.concatenate([rows[-1], rows[0]])
+                pair_idx = numpy.concatenate([pair_idx, seam[numpy.newaxis]])
+            n = rows.shape[1]
+            q = n if closed else n - 1
+            _, f = self._alloc(0, 2*q*pair_idx.shape[0])
+            _strip_faces(pair_idx, n, flip_order=flip_order,
+                         random_diag=random_diag, rng=rng, closed=closed,
+                         out=f)
+    @prof.counted("MeshBuilder.close_idx", lambda self, idx, *a, **kw: idx.shape[0])
+    def close_idx(self, idx, reverse=False):
+        """Like close, but for a boundary given as vertex indices (shape
+        (N,)).  Only the centroid is added as a new vertex.  (This leaves
+        out the all-zero last face that close_boundary_simple has.)"""
+        n = idx.shape[0]
+        tmpl = _fan_template(n, reverse)[:n]
+        c = self.add_verts(numpy.mean(self._v[idx], axis=0)[numpy.newaxis])
+        _, f = self._alloc(0, n)
+        f[:] = numpy.append(idx, c)[tmpl]
+    def clear(self):
+        """Discard everything so far, but keep the buffers for reuse."""
+        self.nv = 0
+        self.nf = 0
+    def to_mesh(self):
+        """Return a FaceVertexMesh of everything so far.
+
+        Its arrays are views into this builder's buffers (not copies), so
+        they are only valid until the next thing is appended.
+        """
+        return FaceVertexMesh(self._v[:self.nv], self._f[:self.nf])
+
+class MeshStats(object):
+    """What a MeshBuilder would end up holding - vertex & face counts,
+    and bounding box - tallied from boundary sizes alone.  This is for
+    dry runs (see meshgen.gen2mesh and cage.CageGen.to_mesh), which walk
+    the same boundaries but don't copy vertices or make any faces.
+
+    Each method below counts what the MeshBuilder method of the same
+    name (or with _idx appended, if 'shared') would add.
+    """
+    def __init__(self):
+        self.nv = 0
+        self.nf = 0
+        self._lo = numpy.full(3, numpy.inf)
+        self._hi = numpy.full(3, -numpy.inf)
+        # Vertices seen but not yet in _lo/_hi (so that many small
+        # boundaries cost one min/max, not one each):
+        self._pending = []
+        self._pending_rows = 0
+    def see(self, vs):
+        # Widen the bounding box to take in 'vs' (shape (...,3)).
+        self._pending.append(vs.reshape(-1, 3))
+        self._pending_rows += self._pending[-1].shape[0]
+        if self._pending_rows >= 65536:
+            self._flush()
+    def _flush(self):
+        if self._pending_rows:
+            vs = numpy.concatenate(self._pending)
+            self._lo = numpy.minimum(self._lo, vs.min(axis=0))
+            self._hi = numpy.maximum(self._hi, vs.max(axis=0))
+        self._pending = []
+        self._pending_rows = 0
+    def add(self, nv, nf):
+        self.nv += nv
+        self.nf += nf
+    def add_stack(self, n, layers):
+        self.nv += n*layers
+    def join_stack(self, n, layers, loop=False, closed=True, shared=False):
+        # 'layers' boundaries of 'n' vertices each:
+        p = layers - 1 + (1 if loop else 0)
+        q = n if closed else n - 1
+        if not shared:
+            self.nv += 2*n*p
+        self.nf += 2*q*p
+    def close(self, n, shared=False):
+        if shared:
+            self.nv += 1
+            self.nf += n
+        else:
+            self.nv += n + 1
+            self.nf += n + 1
+    def bounds(self):
+        # (lo, hi), as for FaceVertexMesh.bounds.  This covers every
+        # boundary vertex; anything else (e.g. centroids) lies inside.
+        self._flush()
+        return self._lo, self._hi
+    def mesh_bytes(self):
+        # Size of the FaceVertexMesh's arrays (float64 & int):
+        return 3*self.nv*8 + 3*self.nf*numpy.dtype(int).itemsize
+    def stl_bytes(self):
+        # Size of the binary STL file (see write_stl):
+        return 84 + stl_dtype.itemsize*self.nf
+    def __repr__(self):
+        lo, hi = self.bounds()
+        return "MeshStats(nv={}, nf={}, lo={}, hi={})".format(
+            self.nv, self.nf, lo.tolist(), hi.tolist())
+
 class Transform(object):
     def __init__(self, mtx=None):
         if mtx is None:
             self.mtx = numpy.identity(4)
         else:
             self.mtx = mtx
+    @prof.counted("Transform._compose", lambda self, mtx2: 1)
     def _compose(self, mtx2):
         # Note pre-multiply. Earlier transforms are done first.
         return Transform(mtx2 @ self.mtx)
@@ -81,12 +654,218 @@ class Transform(object):
         return self._compose(mtx_reflect(*a, **kw))
     def identity(self, *a, **kw):
         return self._compose(mtx_identity(*a, **kw))
+    @prof.counted("Transform.apply_to", lambda self, vs: vs.size // 3)
+    def apply_to(self, vs):
+        # vs has shape (...,3).  Rather than going to homogeneous coords
+        # (appending a column of ones), split the matrix into its linear
+        # 3x3 part A and translation t.  As we have row vectors, we're
+        # doing basically (A*x)^T=(x^T)*(A^T) hence transposing the
+        # matrix, while vectors are already transposed.
+        return vs @ self.mtx[:3,:3].T + self.mtx[:3,3]
+
+class TransformArray(object):
+    """A stack of K transforms, held as one array of shape (K,4,4).
+
+    This has the same methods as Transform, but each one acts on all K
+    transforms at once - e.g. translate() translates every one of them,
+    and compose() accepts either a Transform (applied to all K) or
+    another TransformArray of length K (applied pairwise).
+    """
+    def __init__(self, mtx):
+        self.mtx = mtx
+    @classmethod
+    def Identity(cls, count):
+        return cls(numpy.tile(numpy.identity(4), (count, 1, 1)))
+    @classmethod
+    def from_transforms(cls, xforms):
+        """Stack an iterable of Transform."""
+        return cls(numpy.stack([xf.mtx for xf in xforms]))
+    def to_transforms(self):
+        """Return a list of Transform (whose matrices are views of ours)."""
+        return [Transform(m) for m in self.mtx]
+    def __len__(self):
+        return self.mtx.shape[0]
+    def __getitem__(self, idx):
+        # An integer gives back a Transform; anything else (slice, index
+        # array, mask) gives a TransformArray.
+        m = self.mtx[idx]
+        if m.ndim == 2:
+            return Transform(m)
+        return TransformArray(m)
+    @prof.counted("TransformArray._compose", lambda self, mtx2: len(self))
+    def _compose(self, mtx2):
+        # Note pre-multiply, as in Transform.  mtx2 may be (4,4) or (K,4,4).
+        return TransformArray(numpy.matmul(mtx2, self.mtx))
+    def compose(self, xform):
+        return self._compose(xform.mtx)
+    def scale(self, *a, **kw):
+        return self._compose(mtx_scale(*a, **kw))
+    def translate(self, *a, **kw):
+        return self._compose(mtx_translate(*a, **kw))
+    def rotate(self, *a, **kw):
+        return self._compose(mtx_rotate(*a, **kw))
+    def reflect(self, *a, **kw):
+        return self._compose(mtx_reflect(*a, **kw))
+    def identity(self, *a, **kw):
+        return self._compose(mtx_identity(*a, **kw))
+    @prof.counted("TransformArray.apply_to", lambda self, vs: len(self) * vs.shape[-2])
+    def apply_to(self, vs):
+        """Apply every transform to vertices.
+
+        If 'vs' has shape (N,3), every transform is applied to the same
+        vertices.  If it has shape (K,N,3), transform k is applied to
+        vs[k].  Either way, the result has shape (K,N,3).
+        """
+        # Same affine split as Transform.apply_to, batched over K:
+        a = self.mtx[:,:3,:3]
+        t = self.mtx[:,numpy.newaxis,:3,3]
+        return numpy.matmul(vs, a.transpose(0, 2, 1)) + t
+
+class Similarity(object):
+    """A rotation, uniform scale, and translation stored compactly.
+
+    The data is an array of shape (8,) - or (K,8) for a batch of K -
+    holding a unit quaternion (w,x,y,z), a translation (x,y,z) and a
+    scale s, meaning vertex v goes to s*R*v + t.  This has the same
+    methods as Transform and TransformArray, and by default composes the
+    same way they do: earlier transforms are done first (pre-multiplying,
+    in matrix terms).  It uses half the memory of a 4x4 matrix and
+    composes with quaternion products.
+
+    blender_scraps' xform.Transform composes the other way around
+    (post-multiplying: each new transform is done first, in the frame of
+    the ones before it), so a chain like .translate(...).rotate(...)
+    means something different there.  For that order, pass local=True
+    (as in sweep); the flag carries through every method.
+
+    from_transform/to_transform convert to and from anything with a 4x4
+    'mtx' - this Transform, TransformArray, or xform.Transform - and give
+    the same vertices within tolerance.  (Note that unlike mtx_rotate,
+    rotate() normalizes its axis, so they agree only for unit axes.)
+    """
+    def __init__(self, data=None, local=False):
+        if data is None:
+            data = numpy.array([1, 0, 0, 0, 0, 0, 0, 1], dtype=numpy.float64)
+        self.data = data
+        self.local = local
+    @classmethod
+    def Identity(cls, count, local=False):
+        return cls(numpy.tile(Similarity().data, (count, 1)), local)
+    @classmethod
+    def from_mtx(cls, mtx, rtol=1e-6, local=False):
+        """Convert from 4x4 matrices, shape (4,4) or (K,4,4).  Raises
+        ValueError if they aren't rotation + uniform scale + translation."""
+        a = mtx[..., :3, :3]
+        s = numpy.cbrt(numpy.linalg.det(a))
+        r = a / s[..., numpy.newaxis, numpy.newaxis]
+        rrt = numpy.matmul(r, numpy.swapaxes(r, -1, -2))
+        if not (numpy.all(s > 0) and numpy.allclose(rrt, numpy.identity(3), atol=rtol)):
+            raise ValueError("Matrix is not a similarity transform")
+        return cls(numpy.concatenate([
+            quat.mat2quat(r), mtx[..., :3, 3], s[..., numpy.newaxis]], axis=-1),
+                   local)
+    @classmethod
+    def from_transform(cls, xform, local=False):
+        return cls.from_mtx(xform.mtx, local=local)
+    def to_mtx(self):
+        """Return the equivalent 4x4 matrix - or (K,4,4) matrices."""
+        mtx = numpy.zeros(self.data.shape[:-1] + (4,4))
+        mtx[..., :3, :3] = self.data[..., 7, numpy.newaxis, numpy.newaxis] * \
+            quat.qmat3(self.data[..., 0:4])
+        mtx[..., :3, 3] = self.data[..., 4:7]
+        mtx[..., 3, 3] = 1
+        return mtx
+    def to_transform(self, cls=None):
+        """Return the equivalent Transform (or TransformArray for a batch).
+        'cls' may give another class taking a 4x4 matrix instead."""
+        if cls is None:
+            cls = Transform if self.data.ndim == 1 else TransformArray
+        return cls(self.to_mtx())
+    def __len__(self):
+        if self.data.ndim == 1:
+            raise TypeError("len() of a single Similarity (not a batch)")
+        return self.data.shape[0]
+    def __getitem__(self, idx):
+        if self.data.ndim == 1:
+            raise TypeError("a single Similarity (not a batch) can't be indexed")
+        return Similarity(self.data[idx], self.local)
+    def _compose(self, d2):
+        # Do self then d2 - or, if local, d2 then self.
+        d1 = self.data
+        if self.local:
+            d1, d2 = d2, d1
+        # s2*R2*(s1*R1*v + t1) + t2:
+        q = quat.qmul(d2[..., 0:4], d1[..., 0:4])
+        t = d2[..., 7:8] * quat.qrotate(d2[..., 0:4], d1[..., 4:7]) + d2[..., 4:7]
+        s = d2[..., 7:8] * d1[..., 7:8]
+        return Similarity(numpy.concatenate([q, t, s], axis=-1), self.local)
+    def compose(self, xform):
+        if not isinstance(xform, Similarity):
+            xform = Similarity.from_transform(xform)
+        return self._compose(xform.data)
+    def scale(self, sx, sy=None, sz=None):
+        if (sy is not None and sy != sx) or (sz is not None and sz != sx):
+            raise ValueError("Similarity supports only uniform scale")
+        return self._compose(numpy.array([1, 0, 0, 0, 0, 0, 0, sx], dtype=numpy.float64))
+    def translate(self, x, y, z):
+        return self._compose(numpy.array([1, 0, 0, 0, x, y, z, 1], dtype=numpy.float64))
+    def rotate(self, axis, angle):
+        axis = numpy.array(axis, dtype=numpy.float64)
+        axis = axis / numpy.linalg.norm(axis)
+        q = quaternion.as_float_array(quat.rotation_quaternion(axis, angle))
+        return self._compose(numpy.concatenate([q, [0, 0, 0, 1]]))
+    def identity(self):
+        return self._compose(Similarity().data)
     def apply_to(self, vs):
-        # Homogeneous coords, so append a column of ones. vh is then shape (N,4):
-        vh = numpy.hstack([vs, numpy.ones((vs.shape[0], 1), dtype=vs.dtype)])
-        # As we have row vectors, we're doing basically (A*x)^T=(x^T)*(A^T)
-        # hence transposing the matrix, while vectors are already transposed.
-        return (vh @ self.mtx.T)[:,0:3]
+        """Apply to vertices.  For a single Similarity this is like
+        Transform.apply_to; for a batch it's like TransformArray.apply_to."""
+        # Expanding to 3x3 once per transform and doing a matmul is
+        # cheaper than rotating each vertex by quaternion:
+        d = self.data
+        a = d[..., 7, numpy.newaxis, numpy.newaxis] * quat.qmat3(d[..., 0:4])
+        t = d[..., 4:7]
+        if d.ndim > 1:
+            t = t[:, numpy.newaxis, :]
+        return numpy.matmul(vs, numpy.swapaxes(a, -1, -2)) + t
+
+def sweep(seed, incr, count=None, local=False):
+    """Computes every transform of an iterated sweep at once.
+
+    This is the same as starting from Transform 'seed' and repeatedly
+    composing the increment 'incr', keeping each result - but without
+    doing 'count' sequential compositions in Python.
+
+    Parameters:
+    seed -- Transform for layer 0
+    incr -- Transform to apply at every step, or a TransformArray with
+    a (possibly different) increment for each step
+    count -- number of layers to return, including layer 0 (not needed
+    if 'incr' is a TransformArray: it is then one more than len(incr))
+    local -- if False, layer k+1 is layer k followed by the increment,
+    i.e. xf.compose(incr).  If True, the increment happens first, in
+    the frame of layer k, i.e. incr.compose(xf).
+
+    Returns:
+    TransformArray of length 'count'; element k gives layer k.
+    """
+    if isinstance(incr, TransformArray):
+        powers = mtx_scan(incr.mtx, local)
+        powers = numpy.concatenate([numpy.identity(4)[numpy.newaxis], powers])
+    else:
+        powers = mtx_powers(incr.mtx, count)
+    if local:
+        return TransformArray(numpy.matmul(seed.mtx, powers))
+    else:
+        return TransformArray(numpy.matmul(powers, seed.mtx))
+
+def sweep_layer(seed, incr, i, local=False):
+    """Returns layer 'i' of sweep(seed, incr, ...) as a Transform, using
+    O(log i) matrix products rather than computing layers 0...i-1."""
+    p = numpy.linalg.matrix_power(incr.mtx, i)
+    if local:
+        return Transform(seed.mtx @ p)
+    else:
+        return Transform(p @ seed.mtx)
 
 def mtx_scale(sx, sy=None, sz=None):
     if sy is None:
@@ -127,6 +906,40 @@ def mtx_reflect(axis):
 def mtx_identity():
     return numpy.eye(4)
 
+def mtx_powers(mtx, count):
+    # Returns array of shape (count,4,4) with mtx^0, mtx^1, ...,
+    # mtx^(count-1).  This fills it by doubling: with mtx^0...mtx^(n-1)
+    # done, multiplying all of them by mtx^n gives the next n, so it's
+    # about log2(count) batched products rather than count sequential.
+    p = numpy.zeros((count,4,4))
+    p[0] = numpy.identity(4)
+    m = mtx
+    n = 1
+    while n < count:
+        k = min(n, count - n)
+        numpy.matmul(p[:k], m, out=p[n:n+k])
+        m = m @ m
+        n += k
+    return p
+
+def mtx_scan(mtxs, local=False):
+    # Inclusive prefix scan of composition over mtxs, shape (K,4,4).
+    # Element k of the result is the composition of mtxs[0] through
+    # mtxs[k] - with mtxs[0] done first, i.e. mtxs[k] @ ... @ mtxs[0].
+    # If 'local' is True, the order is reversed: mtxs[0] @ ... @ mtxs[k].
+    # This is a Hillis-Steele scan, so again about log2(K) batched
+    # products.
+    out = numpy.array(mtxs, dtype=numpy.float64)
+    d = 1
+    while d < out.shape[0]:
+        prev = out.copy()
+        if local:
+            numpy.matmul(prev[:-d], prev[d:], out=out[d:])
+        else:
+            numpy.matmul(prev[d:], prev[:-d], out=out[d:])
+        d *= 2
+    return out
+
 def cube(open_xz=False):
     verts = numpy.array([
         lbf, rbf, ltf, rtf,
@@ -208,29 +1021,94 @@ def subdivide_boundary(bound):
         b2[2*i+1,:] = mids[i,:]
     return b2
 
-def join_boundary_simple(bound1, bound2, random_diag=False):
+@functools.lru_cache(maxsize=64)
+def _strip_template(n, flip_order=False, closed=True):
+    # Face-index template for joining two boundaries of n vertices each,
+    # where indices 0...n-1 refer to the first boundary and n...2*n-1 to
+    # the second.  If 'closed' is False, the boundaries are treated as
+    # open polylines and the last vertex doesn't join back to the first.
+    #
+    # Returns array of shape (2, Q, 2, 3) for Q quads: element [d,i]
+    # gives the two triangles of quad i using diagonal d.  This is
+    # read-only since it is shared by every caller.
+    v0 = numpy.arange(n if closed else n - 1)
+    v1 = (v0 + 1) % n
+    t = numpy.stack([
+        numpy.stack([
+            numpy.stack([n + v1, n + v0, v1], axis=-1),
+            numpy.stack([v1,     n + v0, v0], axis=-1),
+        ], axis=1),
+        numpy.stack([
+            numpy.stack([n + v1, n + v0, v0], axis=-1),
+            numpy.stack([v1,     n + v1, v0], axis=-1),
+        ], axis=1),
+    ])
+    if flip_order:
+        # Swapping which boundary comes first also flips the winding:
+        t = (t + n) % (2 * n)
+    t.flags.writeable = False
+    return t
+
+def _strip_faces(pair_idx, n, flip_order=False, random_diag=False, rng=None,
+                 closed=True, out=None):
+    # 'pair_idx' has shape (P, 2*n): each row holds the vertex indices of
+    # one boundary followed by those of the boundary it joins to.  Returns
+    # faces for all P strips at once, shape (P*2*Q, 3) - written into
+    # 'out' if that is given.
+    tmpl = _strip_template(n, flip_order, closed)
+    p = pair_idx.shape[0]
+    q = tmpl.shape[1]
+    if out is None:
+        out = numpy.zeros((p*2*q, 3), dtype=pair_idx.dtype)
+    if random_diag:
+        rng = numpy.random.default_rng(rng)
+        diag = (rng.random((p, q)) < 0.5).astype(numpy.intp)
+        local = tmpl[diag, numpy.arange(q)].reshape(p, -1)
+        out.reshape(p, -1)[:] = numpy.take_along_axis(pair_idx, local, axis=1)
+    else:
+        numpy.take(pair_idx, tmpl[0].reshape(-1), axis=1,
+                   out=out.reshape(p, -1))
+    return out
+
+@prof.counted("join_boundary_simple", lambda bound1, *a, **kw: bound1.shape[0])
+def join_boundary_simple(bound1, bound2, random_diag=False, rng=None):
     # bound1 & bound2 are both arrays of shape (N,3), representing
     # the points of a boundary.  This joins the two boundaries by
     # simply connecting quads (made of 2 triangles) straight across.
     #
     # Winding will proceed in the direction of the first boundary.
     #
+    # If random_diag is True, each quad's diagonal is picked at random;
+    # 'rng' is anything numpy.random.default_rng accepts (e.g. a seed).
+    #
     # Returns FaceVertexMesh.
     n = bound1.shape[0]
     vs = numpy.concatenate([bound1, bound2])
     # Indices 0...N-1 are from bound1, N...2*N-1 are from bound2
-    fs = numpy.zeros((2*n, 3), dtype=int)
-    for i in range(n):
-        v0 = i
-        v1 = (i + 1) % n
-        if random_diag and random.random() < 0.5:
-            fs[2*i]     = [n + v1, n + v0, v0]
-            fs[2*i + 1] = [v1,     n + v1, v0]
-        else:
-            fs[2*i]     = [n + v1, n + v0, v1]
-            fs[2*i + 1] = [v1,     n + v0, v0]
+    fs = _strip_faces(numpy.arange(2*n)[numpy.newaxis,:], n,
+                      random_diag=random_diag, rng=rng)
     return FaceVertexMesh(vs, fs)
 
+@prof.counted("join_boundary_stack", lambda stacks, *a, **kw: _stack_elements(None, stacks))
+def join_boundary_stack(stacks, flip_order=False, loop=False,
+                        random_diag=False, rng=None, closed=True):
+    # Batched join_boundary_simple for whole sweeps.  'stacks' is an array
+    # of shape (L,N,3) - L successive boundaries of N points each - or a
+    # list of such arrays (N and L may differ between them).  Every
+    # consecutive pair of boundaries in a stack is joined, plus the last
+    # to the first if 'loop' is True.  'flip_order' joins each pair as
+    # join_boundary_simple(later, earlier) rather than (earlier, later).
+    #
+    # The result is the same as concatenating join_boundary_simple over
+    # every pair, stack by stack - including each pair getting its own
+    # copy of both boundaries - but done in a few NumPy operations.
+    #
+    # Returns FaceVertexMesh.
+    builder = MeshBuilder(0, 0)
+    builder.join_stack(stacks, flip_order=flip_order, loop=loop,
+                       random_diag=random_diag, rng=rng, closed=closed)
+    return builder.to_mesh()
+
 def join_boundary_optim(bound1, bound2):
     # bound1 and bound2 must stay in order, but we can rotate
     # the starting point to whatever we want. Use distance as
@@ -241,17 +1119,23 @@ def join_boundary_optim(bound1, bound2):
     i = numpy.argmin(errs)
     return join_boundary_simple(bound1, numpy.roll(bound2, i, axis=0))
 
-def close_boundary_simple(bound, reverse=False):
-    # This will fail for any non-convex boundary!
-    centroid = numpy.mean(bound, axis=0)
-    vs = numpy.concatenate([bound, centroid[numpy.newaxis,:]])
-    n = bound.shape[0]
-    # note that n is new the index of the centroid
+@functools.lru_cache(maxsize=64)
+def _fan_template(n, reverse=False):
+    # Faces for close_boundary_simple on a boundary of n vertices, with
+    # the centroid at index n.  (There are n+1 rows, the last one left
+    # as all zeros.)
+    i = numpy.arange(n)
     fs = numpy.zeros((n+1, 3), dtype=int)
     if reverse:
-        for i in range(n):
-            fs[i] = [(i+1) % n, n, i]
+        fs[:n] = numpy.stack([(i+1) % n, numpy.full(n, n), i], axis=-1)
     else:
-        for i in range(n):
-            fs[i] = [i, n, (i+1) % n]
-    return FaceVertexMesh(vs, fs)
+        fs[:n] = numpy.stack([i, numpy.full(n, n), (i+1) % n], axis=-1)
+    fs.flags.writeable = False
+    return fs
+
+@prof.counted("close_boundary_simple", lambda bound, *a, **kw: bound.shape[0])
+def close_boundary_simple(bound, reverse=False):
+    # This will fail for any non-convex boundary!
+    builder = MeshBuilder(bound.shape[0] + 1, bound.shape[0] + 1)
+    builder.close(bound, reverse)
+    return builder.to_mesh()
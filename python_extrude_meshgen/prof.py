@@ -0,0 +1,165 @@
+# Opt-in instrumentation of the hot paths in meshutil, meshgen and cage.
+#
+# Functions decorated with @counted(...) record, per name: how many
+# times they were called, how many elements (vertices, faces, meshes...)
+# they processed, the time spent in them, and optionally the peak
+# memory (via tracemalloc) that they allocated above what was in use
+# when they were called.  Nothing is recorded unless profiling is on,
+# and the only cost when it is off is one extra function call and flag
+# check per decorated call.  A function that only learns how many
+# elements it has partway through (e.g. by consuming a generator) calls
+# add_elements instead.
+#
+# Turn it on either with the context manager:
+#
+#     with prof.profile(memory=True):
+#         mesh = examples.spiral_nested_3()
+#
+# which prints a report at the end, or by setting the environment
+# variable MESHGEN_PROFILE to 1 (or to 'mem' to also track memory), in
+# which case the report is printed to stderr when Python exits (if
+# anything was recorded).
+#
+# Time for a recursive call (e.g. CageGen.to_mesh) is counted only at
+# the outermost level so that it isn't double-counted; calls and
+# elements are counted at every level.
+
+import atexit
+import contextlib
+import functools
+import os
+import sys
+import time
+import tracemalloc
+
+enabled = False
+track_memory = False
+# Whether enable() started tracemalloc (and so disable() should stop it):
+_started_tracing = False
+
+# Name -> Stat:
+stats = {}
+# Names of calls in progress, so recursion can be detected:
+_active = {}
+# One entry per call in progress while tracking memory: [traced memory
+# at entry, highest peak seen by anything called from it].
+_mem_stack = []
+
+class Stat(object):
+    def __init__(self):
+        self.calls = 0
+        self.elements = 0
+        self.seconds = 0.0
+        self.peak_bytes = 0
+
+def counted(name, elements=None):
+    """Decorator to record calls of a function under 'name'.  If given,
+    'elements' is called with the same arguments as the function and
+    returns how many elements that call processes."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*a, **kw):
+            if not enabled:
+                return fn(*a, **kw)
+            stat = stats.get(name)
+            if stat is None:
+                stat = stats[name] = Stat()
+            stat.calls += 1
+            if elements is not None:
+                stat.elements += elements(*a, **kw)
+            depth = _active.get(name, 0)
+            _active[name] = depth + 1
+            if track_memory:
+                cur, peak = tracemalloc.get_traced_memory()
+                if _mem_stack:
+                    # Don't lose the peak so far for whatever called us:
+                    _mem_stack[-1][1] = max(_mem_stack[-1][1], peak)
+                _mem_stack.append([cur, 0])
+                tracemalloc.reset_peak()
+            t0 = time.perf_counter()
+            try:
+                return fn(*a, **kw)
+            finally:
+                dt = time.perf_counter() - t0
+                _active[name] = depth
+                if depth == 0:
+                    stat.seconds += dt
+                if track_memory:
+                    base, seen = _mem_stack.pop()
+                    peak = max(tracemalloc.get_traced_memory()[1], seen)
+                    stat.peak_bytes = max(stat.peak_bytes, peak - base)
+                    if _mem_stack:
+                        _mem_stack[-1][1] = max(_mem_stack[-1][1], peak)
+        return wrapper
+    return deco
+
+def add_elements(name, n):
+    """Add 'n' to the elements recorded under 'name' (if recording), for a
+    @counted function which doesn't know them when it's called."""
+    if not enabled:
+        return
+    stat = stats.get(name)
+    if stat is None:
+        stat = stats[name] = Stat()
+    stat.elements += n
+
+def reset():
+    """Clear anything recorded so far."""
+    stats.clear()
+    _active.clear()
+    del _mem_stack[:]
+
+def enable(memory=False):
+    """Start recording (and clear anything recorded so far)."""
+    global enabled, track_memory, _started_tracing
+    reset()
+    track_memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracing = True
+    enabled = True
+
+def disable():
+    """Stop recording; 'stats' keeps what was recorded."""
+    global enabled, track_memory, _started_tracing
+    enabled = False
+    # (Only if we started it; whoever else did may still be using it)
+    if _started_tracing:
+        tracemalloc.stop()
+        _started_tracing = False
+    track_memory = False
+
+def report(fd=None):
+    """Print a table of everything in 'stats', slowest first."""
+    if fd is None:
+        fd = sys.stdout
+    fd.write("{:<32} {:>10} {:>12} {:>10} {:>12}\n".format(
+        "name", "calls", "elements", "time (s)", "peak (MiB)"))
+    for name, s in sorted(stats.items(), key=lambda kv: -kv[1].seconds):
+        fd.write("{:<32} {:>10} {:>12} {:>10.4f} {:>12.2f}\n".format(
+            name, s.calls, s.elements, s.seconds, s.peak_bytes / 2**20))
+
+@contextlib.contextmanager
+def profile(memory=False, fd=None):
+    """Context manager which records everything inside it, then prints
+    a report (to 'fd', default stdout).  Yields 'stats'."""
+    enable(memory)
+    try:
+        yield stats
+    finally:
+        disable()
+        report(fd)
+
+def _report_at_exit():
+    disable()
+    # Only in the process that turned profiling on (not a forked copy of
+    # it), and only if there's something to report - e.g. not in
+    # examples.main, whose workers report (and reset) for themselves.
+    if os.getpid() == _env_pid and stats:
+        report(sys.stderr)
+
+_env = os.environ.get("MESHGEN_PROFILE", "")
+if _env and _env != "0":
+    enable(memory=(_env == "mem"))
+    _env_pid = os.getpid()
+    atexit.register(_report_at_exit)
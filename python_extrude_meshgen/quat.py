@@ -31,3 +31,67 @@ def quat2mat(q):
         [2*s*(q.x*q.z-q.y*q.w), 2*s*(q.y*q.z+q.x*q.w), 1-2*s*(q.x**2+q.y**2), 0],
         [0, 0, 0, 1],
     ])
+
+# The functions below work on quaternions stored as plain float arrays
+# of shape (...,4) in (w,x,y,z) order - like quaternion.as_float_array
+# gives - so that they vectorize over any number of leading dimensions.
+
+def qmul(a, b):
+    """Hamilton product a*b of float-array quaternions (broadcasts)."""
+    aw, ax, ay, az = [a[..., i] for i in range(4)]
+    bw, bx, by, bz = [b[..., i] for i in range(4)]
+    return numpy.stack([
+        aw*bw - ax*bx - ay*by - az*bz,
+        aw*bx + ax*bw + ay*bz - az*by,
+        aw*by - ax*bz + ay*bw + az*bx,
+        aw*bz + ax*by - ay*bx + az*bw,
+    ], axis=-1)
+
+def qrotate(q, vs):
+    """Rotate vectors 'vs' (...,3) by unit float-array quaternions 'q'
+    (...,4), i.e. the vector part of q*v*conj(q).  Broadcasts."""
+    w = q[..., 0:1]
+    u = q[..., 1:4]
+    uv = numpy.cross(u, vs)
+    return vs + 2*(w*uv + numpy.cross(u, uv))
+
+def qmat3(q):
+    """Rotation matrices (...,3,3) for unit float-array quaternions q
+    (...,4).  This is the upper-left 3x3 part of quat2mat."""
+    w, x, y, z = [q[..., i] for i in range(4)]
+    return numpy.stack([
+        numpy.stack([1-2*(y*y+z*z), 2*(x*y-z*w),   2*(x*z+y*w)],   axis=-1),
+        numpy.stack([2*(x*y+z*w),   1-2*(x*x+z*z), 2*(y*z-x*w)],   axis=-1),
+        numpy.stack([2*(x*z-y*w),   2*(y*z+x*w),   1-2*(x*x+y*y)], axis=-1),
+    ], axis=-2)
+
+def mat2quat(m):
+    """Unit float-array quaternions (...,4) for rotation matrices m
+    (...,3,3); the inverse of qmat3 (up to sign of the quaternion)."""
+    m00, m11, m22 = m[..., 0, 0], m[..., 1, 1], m[..., 2, 2]
+    # p[...,i,j] is 4*q_i*q_j, expressed from the matrix's elements:
+    d = numpy.stack([
+        1 + m00 + m11 + m22,
+        1 + m00 - m11 - m22,
+        1 - m00 + m11 - m22,
+        1 - m00 - m11 + m22,
+    ], axis=-1)
+    wx = m[..., 2, 1] - m[..., 1, 2]
+    wy = m[..., 0, 2] - m[..., 2, 0]
+    wz = m[..., 1, 0] - m[..., 0, 1]
+    xy = m[..., 0, 1] + m[..., 1, 0]
+    xz = m[..., 0, 2] + m[..., 2, 0]
+    yz = m[..., 1, 2] + m[..., 2, 1]
+    p = numpy.stack([
+        numpy.stack([d[..., 0], wx, wy, wz], axis=-1),
+        numpy.stack([wx, d[..., 1], xy, xz], axis=-1),
+        numpy.stack([wy, xy, d[..., 2], yz], axis=-1),
+        numpy.stack([wz, xz, yz, d[..., 3]], axis=-1),
+    ], axis=-2)
+    # Use the row for the largest component, for numerical stability:
+    i = numpy.argmax(d, axis=-1)[..., numpy.newaxis, numpy.newaxis]
+    row = numpy.take_along_axis(p, i, axis=-2)[..., 0, :]
+    big = numpy.take_along_axis(d, i[..., 0], axis=-1)
+    q = row / (2*numpy.sqrt(big))
+    # Keep w non-negative so results are canonical:
+    return q * numpy.where(q[..., 0:1] < 0, -1, 1)
@@ -0,0 +1,25 @@
+import numpy
+
+import examples
+
+def tri_set(mesh, decimals=6):
+    # Every face as its three (rounded) vertex positions, rotated to
+    # start at the smallest, all sorted - so meshes with the same faces
+    # compare equal however their vertices are numbered.
+    t = mesh.v[mesh.f].round(decimals)
+    t = numpy.stack([numpy.roll(t, -j, axis=1) for j in range(3)], axis=1)
+    rows = t.reshape(t.shape[0], 3, 9)
+    first = numpy.array([min(range(3), key=lambda j: tuple(r[j])) for r in rows])
+    rows = rows[numpy.arange(rows.shape[0]), first]
+    return rows[numpy.lexsort(rows.T[::-1])]
+
+def test_ram_horn_branch_shared():
+    # The only example with a fork: with shared=True, the vertices that
+    # the fork's transition shares with the cage before it are matched
+    # up (_share_verts) rather than duplicated.
+    shared = examples.ram_horn_branch(shared=True)
+    stats = examples.ram_horn_branch(shared=True, dry_run=True)
+    assert (shared.nv, shared.nf) == (stats.nv, stats.nf)
+    welded = examples.ram_horn_branch().weld(1e-6)
+    assert (shared.nv, shared.nf) == (welded.nv, welded.nf)
+    assert numpy.array_equal(tri_set(shared), tri_set(welded))
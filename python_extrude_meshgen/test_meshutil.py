@@ -0,0 +1,101 @@
+import numpy
+
+import meshutil
+
+def test_weld_across_cell_boundary():
+    # With tol=1e-3, the grid lines are at multiples of 0.001.  Each pair
+    # straddles one (at x=0.005 or x=0.003) and is much closer than tol;
+    # the two pairs are further apart than tol.
+    v = numpy.array([
+        [0.004999, 0.0005, 0.0005],
+        [0.005001, 0.0005, 0.0005],
+        [0.002999, 0.0005, 0.0005],
+        [0.003001, 0.0005, 0.0005],
+    ])
+    remap, keep = meshutil.weld_vertices(v, 1e-3)
+    assert list(remap) == [0, 0, 1, 1]
+    assert list(keep) == [0, 2]
+
+def test_weld_is_by_distance_not_cell():
+    # 0.9e-3 apart, in one cell: within tol, so merged.  1.1e-3 apart
+    # (in adjacent cells): not.
+    v = numpy.array([
+        [0.0001, 0.0, 0.0],
+        [0.0010, 0.0, 0.0],
+        [0.0100, 0.0, 0.0],
+        [0.0111, 0.0, 0.0],
+    ])
+    remap, keep = meshutil.weld_vertices(v, 1e-3)
+    assert list(remap) == [0, 0, 1, 2]
+
+def test_weld_matches_brute_force():
+    rng = numpy.random.default_rng(0)
+    tol = 1e-3
+    v = rng.uniform(0, 0.02, (300, 3))
+    v = numpy.concatenate([v, v[:50]])
+    remap, keep = meshutil.weld_vertices(v, tol)
+    # Connected components of 'within tol', by brute force:
+    near = numpy.linalg.norm(v[:, None] - v[None], axis=2) <= tol
+    labels = numpy.arange(v.shape[0])
+    while True:
+        new = numpy.array([labels[row].min() for row in near])
+        if numpy.array_equal(new, labels):
+            break
+        labels = new
+    expect_keep = numpy.unique(labels)
+    assert numpy.array_equal(keep, expect_keep)
+    assert numpy.array_equal(remap, numpy.searchsorted(expect_keep, labels))
+
+def test_near_pairs_matches_brute_force():
+    rng = numpy.random.default_rng(1)
+    tol = 1e-3
+    # Half the points are snapped to within 1e-5 of a grid line (a
+    # multiple of tol) on some axis, where pairs straddle cells:
+    v = rng.uniform(0, 0.01, (400, 3))
+    rows = numpy.arange(200)
+    axes = rng.integers(0, 3, 200)
+    v[rows, axes] = (numpy.round(v[rows, axes] / tol) * tol +
+                     rng.uniform(-1e-5, 1e-5, 200))
+    a, b = meshutil.near_pairs(v, tol)
+    d = numpy.linalg.norm(v[:, None] - v[None], axis=2)
+    i, j = numpy.nonzero(numpy.triu(d <= tol, 1))
+    assert sorted(zip(a, b)) == sorted(zip(i, j))
+
+def test_similarity_compose_order():
+    v = numpy.array([[1.0, 2.0, 3.0]])
+    z = [0, 0, 1]
+    def chain(xf):
+        return xf.translate(1, 0, 0).rotate(z, numpy.pi/2).scale(0.5)
+    # Like Transform, each step is done after the ones before:
+    assert numpy.allclose(chain(meshutil.Similarity()).apply_to(v),
+                          chain(meshutil.Transform()).apply_to(v))
+    assert numpy.allclose(chain(meshutil.Similarity()).apply_to(v),
+                          [[-1, 1, 1.5]])
+    # With local=True, each step is done first (post-multiplying, as
+    # blender_scraps' xform.Transform does):
+    mtx = (meshutil.mtx_translate(1, 0, 0) @ meshutil.mtx_rotate(z, numpy.pi/2) @
+           meshutil.mtx_scale(0.5))
+    local = chain(meshutil.Similarity(local=True))
+    assert numpy.allclose(local.to_mtx(), mtx)
+    assert numpy.allclose(local.apply_to(v), [[0, 0.5, 1.5]])
+
+def test_similarity_single_is_not_a_batch():
+    sim = meshutil.Similarity()
+    for f in (len, lambda s: s[0]):
+        try:
+            f(sim)
+        except TypeError:
+            pass
+        else:
+            assert False, "expected TypeError"
+    assert len(meshutil.Similarity.Identity(3)) == 3
+
+def test_weld_rejects_bad_tol():
+    mesh = meshutil.FaceVertexMesh(numpy.zeros((3, 3)), numpy.array([[0, 1, 2]]))
+    for tol in (0, -1e-3, float("nan")):
+        try:
+            mesh.weld(tol)
+        except ValueError:
+            pass
+        else:
+            assert False, "expected ValueError for tol={}".format(tol)